@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Python/ST language tools
+# Copyright (c) 2016 by the contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Benchmark writes into a nested struct/array region, as done by Modbus
+function 16 requests.
+"""
+
+import sys
+import time
+import argparse
+from struct import pack
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+
+from charon.sim.st import Var, Struct, Globals, array, word, dword, real, \
+    string, mem
+from charon.sim.srv import process_request
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--image', action='store_true',
+                    help='keep variables in a flat process image')
+parser.add_argument('--size', type=int, default=4096,
+                    help='number of bytes to write')
+parser.add_argument('--repeat', type=int, default=200,
+                    help='number of repetitions')
+
+opts = parser.parse_args()
+
+if opts.image:
+    mem.use_image()
+
+
+class ST_Channel(Struct):
+    status = Var(word)
+    value = Var(real)
+    params = Var(array(word, 1, 8))
+    name = Var(string(10))
+
+
+class ST_Block(Struct):
+    header = Var(dword)
+    channels = Var(array(ST_Channel, 1, 7))
+    counts = Var(array(word, 1, 14))
+
+
+class Global(Globals):
+    blocks = Var(array(ST_Block, 1, (opts.size + 255) // 256), at='%MB0')
+
+
+g = Global()
+
+# keep the data valid for strings
+data = bytes(range(1, 128)) * (opts.size // 127 + 1)
+data = data[:opts.size]
+
+
+def bench(name, func):
+    started = time.perf_counter()
+    for _ in range(opts.repeat):
+        func()
+    elapsed = time.perf_counter() - started
+    print('%-40s %8.1f us' % (name, 1e6 * elapsed / opts.repeat))
+
+
+def write_block():
+    mem.write(0x10000, data)
+
+
+bench('write %d bytes' % opts.size, write_block)
+
+# the same data as function 16 requests, one per leaf-aligned segment
+requests = []
+segments = [(0, 4)] + [(4 + 32*i, 36 + 32*i) for i in range(7)] + [(228, 256)]
+for ofs in range(0, opts.size, 256):
+    for (start, end) in segments:
+        chunk = data[ofs+start:ofs+end]
+        requests.append(pack('>HHB', 0x3000 + (ofs + start) // 2,
+                             len(chunk) // 2, len(chunk)) + chunk)
+
+
+def write_requests():
+    for req in requests:
+        process_request(mem, 16, req)
+
+
+bench('%d function 16 requests' % len(requests), write_requests)
@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Python/ST language tools
+# Copyright (c) 2016 by the contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Benchmark the Modbus servers of the simulator under concurrent load.
+
+A simulator is started on the project for each server mode, and a number
+of clients send requests, each waiting for the response before sending the
+next one, as fast as they can.  The default addresses are those of
+plc.py (%MB98..%MB155), where reads and writes are valid without --image.
+"""
+
+import sys
+import time
+import random
+import socket
+import signal
+import asyncio
+import argparse
+import subprocess
+from os import path
+from struct import pack, unpack
+
+BASEDIR = path.dirname(path.dirname(path.realpath(__file__)))
+sys.path.insert(0, BASEDIR)
+
+from charon.sim.sched import percentile
+
+# registers accessed by default: 0x3000 + byte address / 2
+READ_REG = 0x3031   # %MB98
+WRITE1_REG = 0x303A  # %MB116, a word
+WRITE_REG = 0x303C  # %MB120, a struct
+
+parser = argparse.ArgumentParser()
+parser.add_argument('input', nargs='?', help='input project',
+                    default=path.join(BASEDIR, 'plc.py'))
+parser.add_argument('--servers', default='threaded,asyncio',
+                    help='comma separated server modes to compare')
+parser.add_argument('--clients', default='1,10,50',
+                    help='comma separated numbers of concurrent clients')
+parser.add_argument('--duration', type=float, default=5., metavar='S',
+                    help='measuring time per server mode and client number')
+parser.add_argument('--mix', default='3:40,4:40,6:10,16:10',
+                    help='function codes and their relative frequency')
+parser.add_argument('--read-size', type=int, default=16, metavar='REGS',
+                    help='registers per read request (function 3 and 4)')
+parser.add_argument('--write-size', type=int, default=4, metavar='REGS',
+                    help='registers per write request (function 16)')
+parser.add_argument('--image', action='store_true',
+                    help='run the simulator with a flat process image')
+parser.add_argument('--cycle-time', type=float, default=5., metavar='MS',
+                    help='cycle time of the simulator')
+parser.add_argument('--port', type=int, default=5502,
+                    help='port for the simulator')
+
+opts = parser.parse_args()
+
+mix = []
+for item in opts.mix.split(','):
+    func, weight = item.split(':')
+    mix.append((int(func), int(weight)))
+funcs = [func for (func, _) in mix]
+weights = [weight for (_, weight) in mix]
+
+
+def make_request(func, tid):
+    if func in (3, 4):
+        pdu = pack('>BHH', func, READ_REG, opts.read_size)
+    elif func == 6:
+        pdu = pack('>BHH', func, WRITE1_REG, tid & 0xffff)
+    elif func == 16:
+        pdu = pack('>BHHB', func, WRITE_REG, opts.write_size,
+                   2 * opts.write_size) + bytes(2 * opts.write_size)
+    else:
+        raise RuntimeError('unsupported function code %d' % func)
+    return pack('>HHHB', tid & 0xffff, 0, len(pdu) + 1, 1) + pdu
+
+
+async def client(port, deadline, latencies, errors, seed):
+    reader, writer = await asyncio.open_connection('localhost', port)
+    rnd = random.Random(seed)
+    tid = 0
+    try:
+        while time.perf_counter() < deadline:
+            tid += 1
+            request = make_request(rnd.choices(funcs, weights)[0], tid)
+            started = time.perf_counter()
+            writer.write(request)
+            header = await reader.readexactly(7)
+            lgth, = unpack('>H', header[4:6])
+            body = await reader.readexactly(lgth - 1)
+            latencies.append(time.perf_counter() - started)
+            if body[0] & 0x80:
+                errors.append(body[0] & 0x7f)
+    finally:
+        writer.close()
+
+
+async def run_load(port, nclients, duration):
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*(client(port, deadline, latencies, errors, i)
+                           for i in range(nclients)))
+    return latencies, errors
+
+
+def start_simulator(server):
+    args = [sys.executable, path.join(BASEDIR, 'bin', 'charon-sim'),
+            opts.input, '--server', server, '--port', str(opts.port),
+            '--cycle-time', str(opts.cycle_time)]
+    if opts.image:
+        args.append('--image')
+    proc = subprocess.Popen(args, stdout=subprocess.DEVNULL)
+    deadline = time.monotonic() + 20
+    while True:
+        try:
+            socket.create_connection(('localhost', opts.port)).close()
+            return proc
+        except ConnectionError:
+            if proc.poll() is not None or time.monotonic() > deadline:
+                proc.kill()
+                raise RuntimeError('simulator did not start')
+            time.sleep(0.1)
+
+
+def stop_simulator(proc):
+    proc.send_signal(signal.SIGINT)
+    try:
+        proc.wait(10)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+        proc.wait()
+
+
+print('%-9s %7s %9s %9s %7s %9s %9s %9s %9s' % (
+    'server', 'clients', 'requests', 'req/s', 'errors',
+    'p50 [ms]', 'p90 [ms]', 'p99 [ms]', 'max [ms]'))
+for server in opts.servers.split(','):
+    proc = start_simulator(server)
+    try:
+        for nclients in map(int, opts.clients.split(',')):
+            latencies, errors = asyncio.run(
+                run_load(opts.port, nclients, opts.duration))
+            latencies.sort()
+            print('%-9s %7d %9d %9.0f %7d %9.3f %9.3f %9.3f %9.3f' % (
+                server, nclients, len(latencies),
+                len(latencies) / opts.duration, len(errors),
+                1000 * percentile(latencies, 50),
+                1000 * percentile(latencies, 90),
+                1000 * percentile(latencies, 99), 1000 * latencies[-1]))
+            sys.stdout.flush()
+    finally:
+        stop_simulator(proc)
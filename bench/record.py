@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Python/ST language tools
+# Copyright (c) 2016 by the contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Benchmark the cost of recording many variables after each cycle."""
+
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+
+from charon.sim.st import Var, Globals, word, real, mem
+from charon.sim.record import Recorder
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--image', action='store_true',
+                    help='keep variables in a flat process image')
+parser.add_argument('--vars', type=int, default=200,
+                    help='number of variables to record')
+parser.add_argument('--samples', type=int, default=20000,
+                    help='number of samples to record')
+parser.add_argument('--rate', type=float, default=1000., metavar='HZ',
+                    help='sample rate; 0 samples as fast as possible')
+
+opts = parser.parse_args()
+
+if opts.image:
+    mem.use_image()
+
+# half words, half reals
+fields = dict(('w%d' % i, Var(word, i)) for i in range(opts.vars // 2))
+fields.update(('r%d' % i, Var(real, i / 2.)) for i in range(opts.vars // 2))
+g = type('Globals_bench', (Globals,), fields)()
+
+directory = tempfile.mkdtemp()
+try:
+    recorder = Recorder(directory, g, sorted(fields))
+    period = 1. / opts.rate if opts.rate else 0
+    worst = 0
+    total = 0
+    deadline = time.perf_counter()
+    for i in range(opts.samples):
+        g.w0 = i
+        started = time.perf_counter()
+        recorder.sample()
+        elapsed = time.perf_counter() - started
+        total += elapsed
+        worst = max(worst, elapsed)
+        if period:
+            deadline += period
+            time.sleep(max(0, deadline - time.perf_counter()))
+    started = time.perf_counter()
+    recorder.close()
+    closing = time.perf_counter() - started
+    print('%d samples of %d variables: %.1f us/sample avg, %.1f us max, '
+          '%d dropped, %.1f ms to close' % (
+              recorder.samples, len(fields), 1e6 * total / opts.samples,
+              1e6 * worst, recorder.dropped, 1000 * closing))
+finally:
+    shutil.rmtree(directory)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Python/ST language tools
+# Copyright (c) 2016 by the contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Benchmark memory use and cycle throughput of the PLC simulation."""
+
+import sys
+import time
+import argparse
+import tracemalloc
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+
+from charon.sim.st import simulate, array, mem
+
+parser = argparse.ArgumentParser()
+parser.add_argument('input', nargs='?', help='input project',
+                    default=path.join(path.dirname(path.dirname(
+                        path.realpath(__file__))), 'plc.py'))
+parser.add_argument('--image', action='store_true',
+                    help='keep variables in a flat process image')
+parser.add_argument('--compile', action='store_true',
+                    help='compile the programs to specialized Python first')
+parser.add_argument('--track', action='store_true',
+                    help='track writes, and take the dirty ranges after '
+                    'each cycle')
+parser.add_argument('--cycles', type=int, default=20000,
+                    help='number of cycles to run')
+parser.add_argument('--type', default='ST_DeviceInfo',
+                    help='type from the project used to measure memory use')
+parser.add_argument('--count', type=int, default=100,
+                    help='number of elements to allocate of that type')
+
+opts = parser.parse_args()
+
+if opts.image:
+    mem.use_image()
+
+ns = {}
+exec(compile(open(opts.input).read(), opts.input, 'exec'), ns)
+
+atype = array(ns[opts.type], 1, opts.count)
+nvars = len(mem.allocations)
+tracemalloc.start()
+atype.default()
+size = tracemalloc.get_traced_memory()[0]
+tracemalloc.stop()
+nvars = len(mem.allocations) - nvars
+print('%d x %s: %d variables, %.0f bytes/element, %.0f bytes/variable' %
+      (opts.count, opts.type, nvars, size / opts.count, size / nvars))
+
+hooks = ()
+if opts.track:
+    mem.track_writes()
+    hooks = (mem.take_dirty,)
+
+started = time.perf_counter()
+simulate(ns['g'], ns['Main'], opts.cycles, compiled=opts.compile,
+         hooks=hooks)
+elapsed = time.perf_counter() - started
+print('%d cycles in %.2f s, %.0f cycles/s' %
+      (opts.cycles, elapsed, opts.cycles / elapsed))
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Python/ST language tools
+# Copyright (c) 2016 by the contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Benchmark the translation of a large synthetic project, or of the
+phases of translating one large module (--module).
+
+Set CHARON_DEBUG=1 to measure with the checking ST node constructors.
+"""
+
+import io
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import contextlib
+from os import path
+
+sys.path.insert(0, path.dirname(path.dirname(path.realpath(__file__))))
+
+from charon.trans import Translator, Source, Unit
+from charon.trans.cache import Cache
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--files', type=int, default=500,
+                    help='number of modules in the project')
+parser.add_argument('--statements', type=int, default=100,
+                    help='number of statements per program')
+parser.add_argument('-j', '--jobs', type=int,
+                    help='number of processes translating in parallel')
+parser.add_argument('--module', type=int, metavar='STATEMENTS',
+                    help='time the phases of translating one module with '
+                    'this many statements instead')
+
+
+def make_module(n, statements):
+    """Returns the code of a module with a struct and a program of about
+    the given number of statements, using only names (no literals)."""
+    lines = ['from charon.sim.st import Struct, Var, program, word, real',
+             '', '',
+             'class S%d(Struct):' % n,
+             '    a = Var(word)',
+             '    b = Var(real)',
+             '', '',
+             '@program(x=Var(word), y=Var(word), z=Var(word))',
+             'def P%d(v):' % n]
+    templates = [
+        ['v.x = v.y + v.z'],
+        ['v.y -= v.x'],
+        ['if v.x > v.y and not v.z:', '    v.z = v.x * v.y', 'else:',
+         '    v.z = v.x << v.y'],
+        ['while v.x < v.y:', '    v.x += v.z', '    if v.x == v.z:',
+         '        break'],
+        ['v.z = -v.x % (v.y | v.z)'],
+    ]
+    count = 0
+    while count < statements:
+        template = templates[count % len(templates)]
+        lines.extend('    ' + line for line in template)
+        count += len(template)
+    return '\n'.join(lines) + '\n'
+
+
+def translate(directory, **kwds):
+    """Translates the project, returns the elapsed time."""
+    started = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        if not Translator(Source.new(directory), **kwds).run():
+            raise RuntimeError('translation failed')
+    return time.perf_counter() - started
+
+
+def time_phases(statements):
+    trans = Translator(None)
+    unit = Unit('module.py', make_module(0, statements))
+    print('module of %d statements, %d lines' % (
+        statements, unit.code.count('\n')))
+    for phase in ('parse', 'translate_ast', 'generate'):
+        started = time.perf_counter()
+        if not getattr(trans, phase)(unit):
+            raise RuntimeError('%s failed' % phase)
+        print('%-14s %7.3f s' % (phase + ':', time.perf_counter() - started))
+
+
+if __name__ == '__main__':
+    opts = parser.parse_args()
+    if opts.module:
+        time_phases(opts.module)
+        sys.exit()
+    directory = tempfile.mkdtemp()
+    try:
+        project = path.join(directory, 'project')
+        cache = path.join(directory, 'cache')
+        for i in range(opts.files):
+            subdir = path.join(project, 'lib%d' % (i // 100))
+            if i % 100 == 0:
+                os.makedirs(subdir)
+            with open(path.join(subdir, 'mod%d.py' % i), 'w') as fp:
+                fp.write(make_module(i, opts.statements))
+        print('%d modules of %d statements' % (opts.files, opts.statements))
+        print('serial:             %7.3f s' % translate(project, jobs=1))
+        print('parallel, cold:     %7.3f s' %
+              translate(project, jobs=opts.jobs, cache=Cache(cache)))
+        print('parallel, no-op:    %7.3f s' %
+              translate(project, jobs=opts.jobs, cache=Cache(cache)))
+        with open(path.join(project, 'lib0', 'mod0.py'), 'a') as fp:
+            fp.write('\n')
+        print('one module changed: %7.3f s' %
+              translate(project, jobs=opts.jobs, cache=Cache(cache)))
+    finally:
+        shutil.rmtree(directory)
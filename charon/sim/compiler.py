@@ -0,0 +1,533 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Python/ST language tools
+# Copyright (c) 2016 by the contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Compiles simulated programs into specialized Python functions.
+
+Variable accesses whose target is known when the program is compiled (like
+``g.iCycle`` or ``v.Data[3]``) are resolved once to the value objects, and
+where only the number is needed, the access is rewritten to use the raw
+value directly.  Stores to integer variables get the wraparound for their
+width.  Everything else (accesses through locals, dynamic indices, and
+operations that the value objects reject, like adding a float to a word)
+keeps the interpreted semantics.
+"""
+
+import ast
+import struct
+import inspect
+import collections
+import builtins
+import textwrap
+
+from charon.trans import Unit, Translator, FatalError
+
+from .st import Var, Struct, ImageValue, Integral, real, anyarray, \
+    make_program, memory
+
+# builtins that only need the numeric value of their arguments
+NUMERIC_BUILTINS = ('abs', 'float', 'int', 'max', 'min', 'round')
+
+# operators supported by the value objects (see NumProxy)
+PROXY_BINOPS = (ast.Add, ast.Sub, ast.Mult, ast.FloorDiv, ast.Mod,
+                ast.BitAnd, ast.BitOr, ast.BitXor, ast.RShift, ast.LShift)
+PROXY_CMPOPS = (ast.Lt, ast.LtE, ast.Gt, ast.GtE, ast.Eq, ast.NotEq)
+# operators that reals support
+REAL_BINOPS = (ast.Add, ast.Sub, ast.Mult, ast.FloorDiv, ast.Mod)
+
+
+def compile_program(prog, _compiled=None):
+    """Returns a compiled version of the program prog.
+
+    Programs called by prog are compiled as well.  If the source of a
+    program is not available, it is returned unchanged.  The PLC's memory
+    must be the active one (see Memory.activate).
+    """
+    if _compiled is None:
+        _compiled = {}
+    if prog in _compiled:
+        return _compiled[prog]
+    # guard against recursion while compiling callees
+    _compiled[prog] = prog
+    func = prog.func
+    if func.__closure__:
+        return prog
+    try:
+        lines, lineno = inspect.getsourcelines(func)
+    except (OSError, TypeError):
+        return prog
+    unit = Unit(func.__code__.co_filename, textwrap.dedent(''.join(lines)))
+    Translator(None).parse(unit)
+    funcdef = unit.ast.body[0]
+    if not isinstance(funcdef, ast.FunctionDef) or len(funcdef.args.args) != 1:
+        raise FatalError('%s: program must take exactly one argument' %
+                         func.__name__)
+    funcdef.decorator_list = []
+    ast.increment_lineno(unit.ast, lineno - 1)
+
+    namespace = dict(func.__globals__)
+    roots = dict((name, obj) for (name, obj) in namespace.items()
+                 if isinstance(obj, Struct))
+    roots[funcdef.args.args[0].arg] = prog.instance
+    for node in ast.walk(funcdef):
+        if isinstance(node, ast.Name) and \
+           getattr(namespace.get(node.id), 'is_program', False):
+            namespace[node.id] = compile_program(namespace[node.id],
+                                                 _compiled)
+
+    ProgramCompiler(roots, namespace).visit_scope(funcdef, instance_arg=True)
+    ast.fix_missing_locations(unit.ast)
+    code = compile(unit.ast, unit.name, 'exec')
+    exec(code, namespace)
+    new_func = make_program(namespace[funcdef.name], prog.instance)
+    _compiled[prog] = new_func
+    return new_func
+
+
+def scope_bindings(funcdef):
+    """Returns a dict mapping the names bound in the scope of funcdef
+    (not in nested scopes) to the number of times they are bound."""
+    bindings = collections.Counter(arg.arg for arg in funcdef.args.args)
+    todo = list(funcdef.body)
+    while todo:
+        node = todo.pop()
+        if isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            bindings[node.name] += 1
+            todo.extend(node.decorator_list)
+            continue
+        elif isinstance(node, ast.Lambda):
+            continue
+        elif isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Load):
+            bindings[node.id] += 1
+        elif isinstance(node, ast.alias):
+            bindings[(node.asname or node.name).split('.')[0]] += 1
+        elif isinstance(node, (ast.Global, ast.Nonlocal)):
+            bindings.update(node.names)
+        todo.extend(ast.iter_child_nodes(node))
+    return bindings
+
+
+class ProgramCompiler(ast.NodeTransformer):
+    """Rewrites the body of a program function."""
+
+    def __init__(self, roots, namespace):
+        # writes are tracked in the memory active while compiling
+        self.mem = memory()
+        self.roots = roots
+        self.namespace = namespace
+        self.consts = {}
+        self.structs = {}
+        # nodes created by raw()
+        self.raw_nodes = set()
+
+    def const(self, obj):
+        """Returns a name under which obj is available to the function."""
+        name = self.consts.get(id(obj))
+        if name is None:
+            name = self.consts[id(obj)] = '_v%d' % len(self.consts)
+            self.namespace[name] = obj
+        return ast.Name(id=name, ctx=ast.Load())
+
+    def resolve(self, node):
+        """Returns the value object an expression always refers to, or None."""
+        if isinstance(node, ast.Name):
+            return self.roots.get(node.id)
+        elif isinstance(node, ast.Attribute):
+            base = self.resolve(node.value)
+            if isinstance(base, Struct) and \
+               isinstance(getattr(type(base), node.attr, None), Var):
+                return getattr(base, node.attr)
+        elif isinstance(node, ast.Subscript):
+            base = self.resolve(node.value)
+            index = self.constant(node.slice)
+            if isinstance(base, anyarray) and isinstance(index, int):
+                try:
+                    return base[index]
+                except RuntimeError:
+                    # leave the error to runtime
+                    return None
+        return None
+
+    def constant(self, node):
+        if isinstance(node, ast.Index):
+            # Python < 3.9
+            node = node.value
+        if isinstance(node, ast.Constant):
+            return node.value
+        return None
+
+    def bit_access(self, node):
+        """Returns (value, bit) for a bit access like ``g.x[[3]]``."""
+        if not isinstance(node, ast.Subscript):
+            return None, None
+        index = node.slice
+        if isinstance(index, ast.Index):
+            index = index.value
+        if not isinstance(index, ast.List) or len(index.elts) != 1:
+            return None, None
+        bit = self.constant(index.elts[0])
+        obj = self.resolve(node.value)
+        if not isinstance(obj, Integral) or not isinstance(bit, int):
+            return None, None
+        return obj, bit
+
+    def packer(self, obj):
+        """Returns the struct and offset used to access a number that is
+        kept in a buffer, or None if obj keeps the value itself."""
+        if not isinstance(obj, ImageValue) or \
+           not isinstance(obj, (Integral, real)):
+            return None
+        fmt = obj.MEMFMT
+        if fmt not in self.structs:
+            self.structs[fmt] = struct.Struct(fmt)
+        return (self.attr(self.const(self.structs[fmt]), 'unpack_from'),
+                self.attr(self.const(self.structs[fmt]), 'pack_into'),
+                self.const(obj.buf), ast.Constant(value=obj.ofs))
+
+    def attr(self, node, name):
+        return ast.Attribute(value=node, attr=name, ctx=ast.Load())
+
+    def raw(self, obj):
+        packer = self.packer(obj)
+        if packer is not None:
+            unpack, _, buf, ofs = packer
+            node = ast.Subscript(value=self.call(unpack, buf, ofs),
+                                 slice=ast.Constant(value=0), ctx=ast.Load())
+        else:
+            node = self.attr(self.const(obj), 'value')
+        self.raw_nodes.add(node)
+        return node
+
+    def store(self, obj, value, wrap=True, integral=True):
+        """Returns the statements storing value into obj; integral tells if
+        value is known to be an integer."""
+        if not wrap:
+            pass
+        elif isinstance(obj, Integral) and not obj.SIGNED:
+            if isinstance(value, ast.Constant) and \
+               isinstance(value.value, int):
+                value = ast.Constant(value=obj.unwrap(value.value))
+            else:
+                value = ast.BinOp(left=value, op=ast.Mod(),
+                                  right=ast.Constant(value=1 << obj.WIDTH))
+        elif isinstance(obj, real) and self.is_raw(value):
+            pass
+        else:
+            value = self.call(self.attr(self.const(obj), 'unwrap'), value)
+        packer = self.packer(obj)
+        if packer is not None and isinstance(obj, Integral) and \
+           not integral:
+            # see Integral._image_set
+            value = self.call(self.const(int), value)
+        stmts = []
+        if not isinstance(value, ast.Constant):
+            # evaluate once, for the comparison with the old value
+            stmts.append(ast.Assign(
+                targets=[ast.Name(id='_new', ctx=ast.Store())], value=value))
+            value = ast.Name(id='_new', ctx=ast.Load())
+        if packer is not None:
+            _, pack, buf, ofs = packer
+            stmt = ast.Expr(value=self.call(pack, buf, ofs, value))
+        else:
+            target = ast.Attribute(value=self.const(obj), attr='value',
+                                   ctx=ast.Store())
+            stmt = ast.Assign(targets=[target], value=value)
+        return stmts + [self.mark(obj, value), stmt]
+
+    def mark(self, obj, value):
+        """Returns a statement recording a write of value to obj if it
+        changes obj, and the memory tracks writes (see
+        Memory.track_writes)."""
+        dirty = self.attr(self.const(self.mem), 'dirty')
+        # if dirty is not None and value != obj: mem.mark(addr, size)
+        return ast.If(
+            test=ast.BoolOp(op=ast.And(), values=[
+                ast.Compare(left=dirty, ops=[ast.IsNot()],
+                            comparators=[ast.Constant(value=None)]),
+                ast.Compare(left=value, ops=[ast.NotEq()],
+                            comparators=[self.raw(obj)])]),
+            body=[ast.Expr(value=self.call(
+                self.attr(self.const(self.mem), 'mark'),
+                ast.Constant(value=obj.addr),
+                ast.Constant(value=obj.sizeof())))],
+            orelse=[])
+
+    def call(self, func, *args):
+        return ast.Call(func=func, args=list(args), keywords=[])
+
+    def is_raw(self, node):
+        """Returns True if the expression is known to give a plain number."""
+        if isinstance(node, (ast.Constant, ast.BinOp, ast.UnaryOp)):
+            return True
+        if node in self.raw_nodes:
+            return True
+        return isinstance(node, ast.Call) and self.is_builtin(node.func)
+
+    def is_builtin(self, node):
+        return isinstance(node, ast.Name) and node.id in NUMERIC_BUILTINS and \
+            self.namespace.get(node.id, getattr(builtins, node.id)) is \
+            getattr(builtins, node.id)
+
+    def kind(self, node):
+        """Returns the type (int or float) of the number an expression
+        gives, if it is known at compile time, else None."""
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, float):
+                return float
+            # includes bool
+            return int if isinstance(node.value, int) else None
+        obj = self.resolve(node)
+        if isinstance(obj, Integral) or self.bit_access(node)[0] is not None:
+            return int
+        elif isinstance(obj, real):
+            return float
+        elif isinstance(node, ast.Compare):
+            return int
+        elif isinstance(node, ast.UnaryOp):
+            if isinstance(node.op, ast.Not):
+                return int
+            return self.kind(node.operand)
+        elif isinstance(node, ast.BinOp):
+            if isinstance(node.op, ast.Div):
+                return float
+            kinds = set([self.kind(node.left), self.kind(node.right)])
+            if None in kinds or isinstance(node.op, ast.Pow):
+                return None
+            return float if float in kinds else int
+        elif isinstance(node, ast.Call) and self.is_builtin(node.func):
+            if node.func.id in ('int', 'float'):
+                return getattr(builtins, node.func.id)
+            kinds = set(self.kind(arg) for arg in node.args)
+            if node.func.id != 'round' and len(kinds) == 1:
+                return kinds.pop()
+        return None
+
+    def same_as_raw(self, node, other, op=None):
+        """Returns True if an operation (a comparison if op is None) of the
+        value that node refers to with the expression other gives the same
+        result with the raw value.  The value objects only combine
+        integers with integers, and reals with numbers."""
+        obj = self.resolve(node)
+        if isinstance(obj, Integral):
+            return self.kind(other) is int
+        elif isinstance(obj, real):
+            return self.kind(other) is not None and \
+                (op is None or isinstance(op, REAL_BINOPS))
+        return True
+
+    def gives_integral(self, node):
+        """Returns True if the expression can give an integer value object
+        itself, not its number."""
+        if isinstance(self.resolve(node), Integral):
+            return True
+        elif isinstance(node, ast.BoolOp):
+            return any(self.gives_integral(value) for value in node.values)
+        elif isinstance(node, ast.IfExp):
+            return self.gives_integral(node.body) or \
+                self.gives_integral(node.orelse)
+        elif isinstance(node, ast.Call) and self.is_builtin(node.func) and \
+                node.func.id in ('max', 'min'):
+            return any(self.gives_integral(arg) for arg in node.args)
+        return False
+
+    def rvalue(self, node):
+        """Transforms an expression whose numeric value is used."""
+        obj = self.resolve(node)
+        if isinstance(obj, (Integral, real)):
+            return self.raw(obj)
+        obj, bit = self.bit_access(node)
+        if obj is not None:
+            return ast.BinOp(
+                left=ast.BinOp(left=self.raw(obj), op=ast.RShift(),
+                               right=ast.Constant(value=bit)),
+                op=ast.BitAnd(), right=ast.Constant(value=1))
+        return self.visit(node)
+
+    def visit_stmts(self, stmts):
+        result = []
+        for stmt in stmts:
+            new = self.visit(stmt)
+            if isinstance(new, list):
+                result.extend(new)
+            elif new is not None:
+                result.append(new)
+        return result
+
+    # expressions
+
+    def visit_Name(self, node):
+        obj = self.resolve(node)
+        if obj is not None and isinstance(node.ctx, ast.Load):
+            return self.const(obj)
+        return node
+
+    def visit_Attribute(self, node):
+        obj = self.resolve(node)
+        if obj is not None and isinstance(node.ctx, ast.Load):
+            return self.const(obj)
+        node.value = self.visit(node.value)
+        return node
+
+    def visit_Subscript(self, node):
+        obj = self.resolve(node)
+        if obj is not None and isinstance(node.ctx, ast.Load):
+            return self.const(obj)
+        if isinstance(node.ctx, ast.Load):
+            obj, bit = self.bit_access(node)
+            if obj is not None:
+                return self.rvalue(node)
+        node.value = self.visit(node.value)
+        if isinstance(node.slice, ast.Index):
+            node.slice.value = self.rvalue(node.slice.value)
+        elif not isinstance(node.slice, ast.List):
+            node.slice = self.rvalue(node.slice)
+        return node
+
+    def visit_BinOp(self, node):
+        # with a number on the left (e.g. 1.5 + g.x), the value objects
+        # compute the result from the raw value anyway
+        if not isinstance(node.op, PROXY_BINOPS) or \
+           not self.same_as_raw(node.left, node.right, node.op) or \
+           isinstance(self.resolve(node.right), (Integral, real)) and \
+           self.kind(node.left) is None:
+            return self.generic_visit(node)
+        node.left = self.rvalue(node.left)
+        node.right = self.rvalue(node.right)
+        return node
+
+    def visit_UnaryOp(self, node):
+        node.operand = self.rvalue(node.operand)
+        return node
+
+    def visit_BoolOp(self, node):
+        node.values = [self.rvalue(value) for value in node.values]
+        return node
+
+    def visit_Compare(self, node):
+        operands = [node.left] + node.comparators
+        for (op, left, right) in zip(node.ops, operands, operands[1:]):
+            if not isinstance(op, PROXY_CMPOPS) or \
+               not self.same_as_raw(left, right) or \
+               not self.same_as_raw(right, left):
+                return self.generic_visit(node)
+        node.left = self.rvalue(node.left)
+        node.comparators = [self.rvalue(comp) for comp in node.comparators]
+        return node
+
+    def visit_IfExp(self, node):
+        node.test = self.rvalue(node.test)
+        node.body = self.visit(node.body)
+        node.orelse = self.visit(node.orelse)
+        return node
+
+    def visit_Call(self, node):
+        if self.is_builtin(node.func) and self.builtin_same_as_raw(node):
+            node.args = [self.rvalue(arg) for arg in node.args]
+            return node
+        return self.generic_visit(node)
+
+    def builtin_same_as_raw(self, node):
+        """Returns True if a call of a numeric builtin gives the same
+        result with the raw values of the arguments."""
+        name, args = node.func.id, node.args
+        if name in ('max', 'min'):
+            # the arguments are compared with each other
+            return all(self.same_as_raw(arg, other) for arg in args
+                       for other in args if other is not arg)
+        objs = [self.resolve(arg) for arg in args]
+        if name == 'int':
+            # reals have no __index__
+            return not any(isinstance(obj, real) for obj in objs)
+        elif name == 'round':
+            return not any(isinstance(obj, (Integral, real)) for obj in objs)
+        return True
+
+    # statements
+
+    def visit_If(self, node):
+        node.test = self.rvalue(node.test)
+        node.body = self.visit_stmts(node.body)
+        node.orelse = self.visit_stmts(node.orelse)
+        return node
+
+    visit_While = visit_If
+
+    def visit_scope(self, funcdef, instance_arg=False):
+        """Rewrites the body of a function, with its own local names."""
+        outer = self.roots
+        bindings = scope_bindings(funcdef)
+        self.roots = dict((name, obj) for (name, obj) in outer.items()
+                          if name not in bindings)
+        if instance_arg:
+            name = funcdef.args.args[0].arg
+            if bindings[name] == 1:
+                self.roots[name] = outer[name]
+        # locals assigned only once, at the top level, alias a variable
+        for stmt in funcdef.body:
+            if isinstance(stmt, ast.Assign) and len(stmt.targets) == 1 and \
+               isinstance(stmt.targets[0], ast.Name) and \
+               bindings[stmt.targets[0].id] == 1:
+                obj = self.resolve(stmt.value)
+                if obj is not None:
+                    self.roots[stmt.targets[0].id] = obj
+        funcdef.body = self.visit_stmts(funcdef.body)
+        self.roots = outer
+
+    def visit_FunctionDef(self, node):
+        node.decorator_list = [self.visit(d) for d in node.decorator_list]
+        self.visit_scope(node)
+        return node
+
+    def visit_Assign(self, node):
+        if len(node.targets) == 1:
+            target = node.targets[0]
+            obj = self.resolve(target)
+            # reals keep an integer value object assigned to them
+            if isinstance(obj, Integral) or isinstance(obj, real) and \
+               not self.gives_integral(node.value):
+                return self.store(obj, self.rvalue(node.value),
+                                  integral=self.kind(node.value) is int)
+            obj, bit = self.bit_access(target)
+            if obj is not None and \
+               not isinstance(self.resolve(node.value), real):
+                # x[[bit]] = value
+                value = ast.BinOp(
+                    left=ast.BinOp(left=self.raw(obj), op=ast.BitAnd(),
+                                   right=ast.Constant(value=~(1 << bit))),
+                    op=ast.BitOr(),
+                    right=ast.BinOp(
+                        left=ast.BinOp(left=self.rvalue(node.value),
+                                       op=ast.BitAnd(),
+                                       right=ast.Constant(value=1)),
+                        op=ast.LShift(), right=ast.Constant(value=bit)))
+                return self.store(obj, value, wrap=False)
+        return self.generic_visit(node)
+
+    def visit_AugAssign(self, node):
+        obj = self.resolve(node.target)
+        if isinstance(obj, (Integral, real)) and \
+           isinstance(node.op, PROXY_BINOPS) and \
+           self.same_as_raw(node.target, node.value, node.op):
+            return self.store(obj, ast.BinOp(left=self.raw(obj), op=node.op,
+                                             right=self.rvalue(node.value)))
+        return self.generic_visit(node)
@@ -22,7 +22,7 @@
 #
 # *****************************************************************************
 
-from .st import mem
+from .st import memory
 
 
 def adr(val):
@@ -34,9 +34,9 @@ def sizeof(val):
 
 
 def memset(adr, byte, count):
-    mem.write(adr, chr(byte).encode() * count)
+    memory().write(adr, chr(byte).encode() * count)
 
 
 def memcpy(toadr, fromadr, count):
-    data = mem.read(fromadr, count)
-    mem.write(toadr, data)
+    mem = memory()
+    mem.write(toadr, mem.read(fromadr, count))
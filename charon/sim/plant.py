@@ -0,0 +1,203 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Python/ST language tools
+# Copyright (c) 2016 by the contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Simulation of a plant of many PLCs, spread over worker processes."""
+
+import os
+import sys
+import time
+import queue
+import signal
+import collections
+import multiprocessing
+
+from .st import load
+from .sched import Scheduler
+
+
+def read_plant(filename):
+    """Reads a plant description.
+
+    Each line is "file port [group]".  PLCs with the same group are run in
+    the same worker process; PLCs without a group get a process of their
+    own.  File names are relative to the plant description.  Returns an
+    ordered dict mapping group names to lists of (file, port).
+    """
+    groups = collections.OrderedDict()
+    basedir = os.path.dirname(os.path.abspath(filename))
+    with open(filename) as fp:
+        for (lineno, line) in enumerate(fp, 1):
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            parts = line.split()
+            if len(parts) not in (2, 3) or not parts[1].isdigit():
+                raise RuntimeError('%s:%d: expected "file port [group]"' %
+                                   (filename, lineno))
+            path = os.path.join(basedir, parts[0])
+            group = parts[2] if len(parts) == 3 else '%s:%s' % (
+                os.path.basename(parts[0]), parts[1])
+            groups.setdefault(group, []).append((path, int(parts[1])))
+    return groups
+
+
+def run_group(group, plcs, options, stats, stop, interval):
+    """Worker process: runs a group of PLCs until stop is set.
+
+    Every interval seconds, and when stopping, the scheduler statistics are
+    put into the stats queue as (group, pid, stats dict).
+    """
+    # the supervisor handles Ctrl-C and tells us to stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    plcs = [load(path, port, options.get('image', False))
+            for (path, port) in plcs]
+    for plc in plcs:
+        if options.get('compiled'):
+            from .compiler import compile_program
+            with plc.mem.activate():
+                plc.mainfunc = compile_program(plc.mainfunc)
+        plc.start_server(options.get('server', 'threaded'))
+
+    sched = Scheduler(options.get('cycle_time', 0.005))
+    next_report = [time.monotonic() + interval]
+
+    def cycle():
+        for plc in plcs:
+            plc.cycle()
+        # checking the event takes a lock, so only do it now and then
+        if sched.cycles % 50 == 0:
+            if stop.is_set():
+                sched.stop()
+            elif time.monotonic() >= next_report[0]:
+                next_report[0] += interval
+                stats.put((group, os.getpid(), sched.stats()))
+
+    try:
+        sched.run(cycle)
+    finally:
+        for plc in plcs:
+            if plc.server is not None:
+                plc.server.shutdown()
+        stats.put((group, os.getpid(), sched.stats()))
+
+
+class Plant(object):
+    """Supervises the worker processes of a plant.
+
+    Collects the statistics the workers report, and stops them all when
+    asked to or when one of them dies.
+    """
+
+    def __init__(self, groups, options=None, interval=1.0):
+        self.groups = groups
+        self.options = options or {}
+        self.interval = interval
+        self.stats = multiprocessing.Queue()
+        self.stop_event = multiprocessing.Event()
+        self.processes = collections.OrderedDict()
+        # latest statistics per group
+        self.latest = collections.OrderedDict((g, None) for g in groups)
+
+    def start(self):
+        for (group, plcs) in self.groups.items():
+            proc = multiprocessing.Process(
+                target=run_group, name='plant-%s' % group,
+                args=(group, plcs, self.options, self.stats,
+                      self.stop_event, self.interval))
+            proc.start()
+            self.processes[group] = proc
+
+    def collect(self, timeout=0):
+        """Reads statistics from the workers, waiting up to timeout."""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                group, pid, stats = self.stats.get(
+                    timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                return
+            stats['pid'] = pid
+            self.latest[group] = stats
+
+    def dead(self):
+        """Returns the groups whose process has exited."""
+        return [group for (group, proc) in self.processes.items()
+                if not proc.is_alive()]
+
+    def stop(self, timeout=5.0):
+        """Asks all workers to stop, and kills the ones that do not."""
+        self.stop_event.set()
+        deadline = time.monotonic() + timeout
+        # keep reading, a worker cannot exit while its queue feeder blocks
+        while len(self.dead()) < len(self.processes) and \
+                time.monotonic() < deadline:
+            self.collect(0.05)
+        for proc in self.processes.values():
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+        self.collect()
+
+    def supervise(self, out=sys.stdout):
+        """Prints the statistics every interval until interrupted or a
+        worker dies, then stops the plant.  Returns the groups whose
+        worker died."""
+        dead = []
+        try:
+            while True:
+                self.collect(self.interval)
+                out.write(self.report() + '\n\n')
+                out.flush()
+                dead = self.dead()
+                if dead:
+                    out.write('worker for %s exited, stopping plant\n' %
+                              ', '.join(dead))
+                    break
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+        out.write(self.report() + '\n')
+        return dead
+
+    def report(self):
+        """Returns a table of the latest statistics of all groups."""
+        lines = ['%-24s %4s %7s %10s %8s %6s %9s %9s' % (
+            'group', 'PLCs', 'pid', 'cycles', 'overruns', 'load',
+            'p99 [ms]', 'max [ms]')]
+        totals = [0, 0]
+        for (group, stats) in self.latest.items():
+            if stats is None:
+                lines.append('%-24s %4d %7s' % (
+                    group, len(self.groups[group]), 'starting'))
+                continue
+            totals[0] += stats['cycles']
+            totals[1] += stats['overruns']
+            lines.append('%-24s %4d %7d %10d %8d %5.1f%% %9.3f %9.3f' % (
+                group, len(self.groups[group]), stats['pid'],
+                stats['cycles'], stats['overruns'], 100 * stats['load'],
+                1000 * stats['jitter_p99'], 1000 * stats['jitter_max']))
+        lines.append('%-24s %4d %7s %10d %8d' % (
+            'total', sum(map(len, self.groups.values())), '',
+            totals[0], totals[1]))
+        return '\n'.join(lines)
@@ -0,0 +1,178 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Python/ST language tools
+# Copyright (c) 2016 by the contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Cycle-time profiling of PLC programs."""
+
+import sys
+import time
+import linecache
+import collections
+
+from .st import find_programs
+from .sched import percentile
+
+
+class Profiler(object):
+    """Measures the time spent in each program (POU) per cycle.
+
+    A call of the main program is one cycle (with several PLCs, a cycle of
+    any of them).  Between start() and stop(), the programs are replaced by
+    timing wrappers; there is no cost otherwise.  With lines set, the time
+    spent on each source line of the programs is measured as well, using a
+    trace function, which slows down all Python code considerably.
+    """
+
+    # number of recent cycles kept for the statistics
+    WINDOW = 10000
+
+    def __init__(self, lines=False):
+        self.lines = lines
+        self.cycles = 0
+        # per POU: total time per recent cycle, including called POUs
+        self.times = collections.defaultdict(
+            lambda: collections.deque(maxlen=self.WINDOW))
+        # per POU: number of calls, total time with and without called POUs
+        self.calls = collections.Counter()
+        self.total_time = collections.Counter()
+        self.self_time = collections.Counter()
+        # per call stack ('Main;Indexer'): total time excluding callees
+        self.stacks = collections.Counter()
+        # per (filename, lineno): total time, including callees
+        self.line_times = collections.Counter()
+        # entries: [stack, start time, time in callees, last line, line start]
+        self._stack = []
+        self._cycle = collections.Counter()
+        self._codes = set()
+        # (namespace, name, program) replaced by start()
+        self._patched = []
+
+    def start(self, mainfunc):
+        """Starts profiling mainfunc and the programs it calls.
+
+        Returns the wrapped main program, which must be called instead.
+        """
+        programs = find_programs(mainfunc)
+        wrappers = dict((prog, self._wrap(prog)) for prog in programs)
+        for prog in programs:
+            namespace = prog.func.__globals__
+            for (name, obj) in list(namespace.items()):
+                if getattr(obj, 'is_program', False) and obj in wrappers:
+                    self._patched.append((namespace, name, obj))
+                    namespace[name] = wrappers[obj]
+        if self.lines:
+            self._codes.update(prog.func.__code__ for prog in programs)
+            sys.settrace(self._trace)
+        return wrappers[mainfunc]
+
+    def stop(self):
+        """Stops profiling and restores the programs."""
+        sys.settrace(None)
+        for (namespace, name, prog) in self._patched:
+            namespace[name] = prog
+        self._patched = []
+
+    def _wrap(self, prog):
+        name = prog.func.__name__
+        func = prog.func
+        instance = prog.instance
+        clock = time.perf_counter
+        enter = self._enter
+        leave = self._leave
+
+        def wrapper():
+            enter(name, clock())
+            try:
+                func(instance)
+            finally:
+                leave(clock())
+        wrapper.is_program = True
+        wrapper.func = func
+        wrapper.instance = instance
+        return wrapper
+
+    def _enter(self, name, now):
+        stack = self._stack[-1][0] + ';' + name if self._stack else name
+        self._stack.append([stack, now, 0.0, None, now])
+
+    def _leave(self, now):
+        stack, started, inner, _, _ = self._stack.pop()
+        elapsed = now - started
+        name = stack.rpartition(';')[2]
+        self.calls[name] += 1
+        self.total_time[name] += elapsed
+        self.self_time[name] += elapsed - inner
+        self.stacks[stack] += elapsed - inner
+        self._cycle[name] += elapsed
+        if self._stack:
+            self._stack[-1][2] += elapsed
+        else:
+            # main program returned: cycle done
+            self.cycles += 1
+            for (name, elapsed) in self._cycle.items():
+                self.times[name].append(elapsed)
+            self._cycle.clear()
+
+    def _trace(self, frame, event, arg):
+        if event == 'call' and frame.f_code in self._codes:
+            return self._trace_lines
+
+    def _trace_lines(self, frame, event, arg):
+        if event in ('line', 'return'):
+            now = time.perf_counter()
+            entry = self._stack[-1]
+            if entry[3] is not None:
+                self.line_times[frame.f_code.co_filename, entry[3]] += \
+                    now - entry[4]
+            entry[3] = frame.f_lineno
+            entry[4] = now
+        return self._trace_lines
+
+    def report(self, nlines=20):
+        """Returns a summary of the timing statistics."""
+        if not self.cycles:
+            return 'no cycles profiled'
+        lines = ['%-24s %8s %9s %9s %9s %9s %9s' % (
+            'POU (ms/cycle)', 'calls', 'min', 'avg', 'p99', 'max', 'self')]
+        for (name, _) in sorted(self.self_time.items(), key=lambda x: -x[1]):
+            values = sorted(self.times[name])
+            lines.append('%-24s %8d %9.3f %9.3f %9.3f %9.3f %9.3f' % (
+                name, self.calls[name], 1000 * values[0],
+                1000 * self.total_time[name] / self.cycles,
+                1000 * percentile(values, 99), 1000 * values[-1],
+                1000 * self.self_time[name] / self.cycles))
+        if self.line_times:
+            lines.append('')
+            lines.append('%-24s %9s  %s' % ('line', 'ms/cycle', 'source'))
+            for ((fn, lineno), total) in self.line_times.most_common(nlines):
+                lines.append('%-24s %9.4f  %s' % (
+                    '%s:%d' % (fn[-18:], lineno), 1000 * total / self.cycles,
+                    linecache.getline(fn, lineno).strip()))
+        return '\n'.join(lines)
+
+    def write_stacks(self, filename):
+        """Writes the time per call stack in collapsed-stack format (as
+        used by flamegraph.pl), in microseconds."""
+        with open(filename, 'w') as fp:
+            for (stack, total) in sorted(self.stacks.items()):
+                fp.write('%s %d\n' % (stack, round(total * 1e6)))
@@ -0,0 +1,199 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Python/ST language tools
+# Copyright (c) 2016 by the contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Change-of-value subscriptions to PLC memory.
+
+Instead of polling over Modbus, clients (e.g. an HMI) subscribe to memory
+ranges or variables and get only what changed after each cycle.  All
+numbers are big-endian.
+
+Client messages:
+  'A' id:u16 addr:u32 size:u16    subscribe to a byte range
+  'N' id:u16 len:u16 name         subscribe to a global variable, like
+                                  'Devices[1].Value'
+  'U' id:u16                      unsubscribe
+
+Server messages:
+  'D' id:u16 offset:u16 len:u16 data    changed bytes of a subscription;
+                                        all of it right after subscribing
+  'C' cycle:u32                         end of the changes of one cycle
+  'E' id:u16 len:u16 message            subscribing failed
+
+The subscription ids are chosen by the client.
+"""
+
+import bisect
+import asyncio
+import threading
+import collections
+from struct import pack, unpack
+
+from .st import lookup
+
+# granularity of change detection, in bytes
+BLOCK = 64
+
+# unsent data after which a client is disconnected
+MAX_BUFFERED = 1 << 20
+
+
+class Publisher(object):
+    """Publishes changes of subscribed memory to clients.
+
+    Connections are served from an asyncio event loop in its own thread;
+    the memory is read in the PLC thread by publish(), which must be called
+    after each cycle (it is a PLC hook).
+
+    Only subscriptions to memory written since the last call are checked
+    for changes, using the write tracking of the memory.  With a shared
+    image, which other processes can write to, all are checked.
+    """
+
+    def __init__(self, plc, port=5010):
+        self.plc = plc
+        self.cycles = 0
+        # (writer, id) -> [addr, size, last published data]
+        self.subscriptions = {}
+        # subscription changes from the connections, for the PLC thread
+        self.commands = collections.deque()
+        self.tracking = plc.mem.shm is None
+        if self.tracking:
+            plc.mem.track_writes()
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(asyncio.start_server(
+            self.handle, 'localhost', port, reuse_address=True))
+
+    def start(self):
+        """Starts serving in a new thread."""
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            self.loop.run_until_complete(self.server.wait_closed())
+            self.loop.close()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def _resolve(self, name):
+        var = lookup(self.plc.glob, name)
+        if getattr(var, 'addr', None) is None:
+            raise RuntimeError('%s has no address' % name)
+        return var.addr, var.sizeof()
+
+    def _send(self, writer, data):
+        # called in the event loop; drop clients that do not keep up
+        if writer.transport.get_write_buffer_size() > MAX_BUFFERED:
+            writer.close()
+        else:
+            writer.write(data)
+
+    def _subscribe(self, writer, sid, addr, size, out):
+        try:
+            if isinstance(addr, str):
+                addr, size = self._resolve(addr)
+            data = self.plc.mem.read_block(addr, size)
+        except Exception as err:
+            msg = str(err).encode()
+            out.setdefault(writer, []).append(
+                b'E' + pack('>HH', sid, len(msg)) + msg)
+            return
+        self.subscriptions[writer, sid] = [addr, size, data]
+        out.setdefault(writer, []).append(
+            b'D' + pack('>HHH', sid, 0, size) + data)
+
+    def publish(self):
+        """Sends the changes since the last call to the subscribers."""
+        self.cycles += 1
+        out = {}
+        while self.commands:
+            cmd = self.commands.popleft()
+            if cmd[0] == 'sub':
+                self._subscribe(*cmd[1:], out=out)
+            elif cmd[0] == 'unsub':
+                self.subscriptions.pop(cmd[1:], None)
+            else:  # connection closed
+                for key in [k for k in self.subscriptions if k[0] is cmd[1]]:
+                    del self.subscriptions[key]
+        if self.tracking:
+            written = self.plc.mem.take_dirty()
+            starts = [start for (start, _) in written]
+        read_block = self.plc.mem.read_block
+        for ((writer, sid), sub) in self.subscriptions.items():
+            addr, size, last = sub
+            if self.tracking:
+                # last written range starting before the end of ours
+                i = bisect.bisect_left(starts, addr + size) - 1
+                if i < 0 or sum(written[i]) <= addr:
+                    continue
+            data = read_block(addr, size)
+            if data == last:
+                continue
+            sub[2] = data
+            msgs = out.setdefault(writer, [])
+            # send runs of changed blocks
+            start = None
+            for ofs in range(0, size + BLOCK, BLOCK):
+                changed = ofs < size and \
+                    data[ofs:ofs+BLOCK] != last[ofs:ofs+BLOCK]
+                if changed and start is None:
+                    start = ofs
+                elif not changed and start is not None:
+                    end = min(ofs, size)
+                    msgs.append(b'D' + pack('>HHH', sid, start, end - start) +
+                                data[start:end])
+                    start = None
+        if out:
+            end = b'C' + pack('>I', self.cycles)
+            for (writer, msgs) in out.items():
+                msgs.append(end)
+                self.loop.call_soon_threadsafe(self._send, writer,
+                                               b''.join(msgs))
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                kind = await reader.readexactly(1)
+                sid, = unpack('>H', await reader.readexactly(2))
+                if kind == b'A':
+                    addr, size = unpack('>IH', await reader.readexactly(6))
+                    self.commands.append(('sub', writer, sid, addr, size))
+                elif kind == b'N':
+                    lgth, = unpack('>H', await reader.readexactly(2))
+                    name = (await reader.readexactly(lgth)).decode()
+                    self.commands.append(('sub', writer, sid, name, None))
+                elif kind == b'U':
+                    self.commands.append(('unsub', writer, sid))
+                else:
+                    return
+        except (asyncio.IncompleteReadError, ConnectionError,
+                UnicodeDecodeError):
+            pass
+        finally:
+            self.commands.append(('closed', writer))
+            writer.close()
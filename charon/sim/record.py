@@ -0,0 +1,182 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Python/ST language tools
+# Copyright (c) 2016 by the contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Recording of variable values at every cycle."""
+
+import os
+import sys
+import time
+import queue
+import struct
+import threading
+from array import array
+
+from .st import ImageValue, Integral, real, lookup
+
+# array type codes for the variable types, by MEMFMT
+TYPECODES = {'B': 'B', 'H': 'H', 'I': 'I', 'f': 'f', 'd': 'd'}
+
+# size of the .npy header we write, including magic and version
+NPY_HEADER_SIZE = 128
+
+
+def npy_header(typecode, count):
+    """Returns the header of a version 1.0 .npy file with count items."""
+    itemsize = array(typecode).itemsize
+    descr = '%s%s%d' % ('<' if sys.byteorder == 'little' else '>',
+                        'f' if typecode in 'fd' else 'u', itemsize)
+    header = "{'descr': '%s', 'fortran_order': False, 'shape': (%d,), }" % (
+        descr, count)
+    header = header.ljust(NPY_HEADER_SIZE - 10 - 1) + '\n'
+    return b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + \
+        header.encode('latin1')
+
+
+class Recorder(object):
+    """Records the values of numeric variables after each cycle.
+
+    Samples are stored in preallocated chunks of array-backed columns.
+    Full chunks are written by a background thread, so that the cycle never
+    waits for the disk: each column goes to its own .npy file in directory,
+    named after the variable.  Besides the variables, the columns 'cycle'
+    (the sample number) and 'time' (time.monotonic()) are recorded.
+
+    If the writer falls behind so far that no free chunk is left, samples
+    are dropped and counted in the dropped attribute.
+    """
+
+    def __init__(self, directory, glob, names, chunk_size=4096, chunks=4):
+        self.directory = directory
+        self.chunk_size = chunk_size
+        self.columns = [('cycle', 'Q', None), ('time', 'd', None)]
+        for name in names:
+            var = lookup(glob, name)
+            if not isinstance(var, (Integral, real)):
+                raise RuntimeError('can only record numbers: %s' % name)
+            self.columns.append((name, TYPECODES[var.MEMFMT], var))
+        self.samples = 0
+        self.dropped = 0
+        self.free = queue.Queue()
+        self.full = queue.Queue()
+        for _ in range(chunks):
+            self.free.put([array(code, bytes(array(code).itemsize *
+                                             chunk_size))
+                           for (_, code, _) in self.columns])
+        os.makedirs(directory, exist_ok=True)
+        self.files = []
+        for (name, code, _) in self.columns:
+            fp = open(os.path.join(directory, name + '.npy'), 'wb')
+            fp.write(npy_header(code, 0))
+            self.files.append(fp)
+        self._make_sampler()
+        self._chunk = None
+        self._sample = None
+        self._pos = chunk_size
+        self._thread = threading.Thread(target=self._writer, daemon=True)
+        self._thread.start()
+
+    def _make_sampler(self):
+        # generate a function that stores one sample into a chunk, with
+        # one statement per column and no loop; numbers in the process
+        # image are read with one unpack per buffer
+        ns = {'clock': time.monotonic}
+        code = ['def bind(%s):' % ', '.join(
+            'c%d' % i for i in range(len(self.columns))),
+                '    def sample(pos, cycle):',
+                '        c0[pos] = cycle',
+                '        c1[pos] = clock()']
+        buffers = {}
+        for (i, (_, _, var)) in enumerate(self.columns[2:], 2):
+            if isinstance(var, ImageValue):
+                buffers.setdefault(id(var.buf), []).append((var.ofs, i, var))
+            else:
+                ns['v%d' % i] = var
+                code.append('        c%d[pos] = v%d.value' % (i, i))
+        for (n, items) in enumerate(buffers.values()):
+            items.sort()
+            start = end = items[0][0]
+            fmt = '='
+            targets = []
+            for (ofs, i, var) in items:
+                if ofs < end:
+                    # overlaps the previous one: read it separately
+                    ns['u%d' % i] = struct.Struct(var.MEMFMT).unpack_from
+                    ns['b%d' % i] = var.buf
+                    code.append('        c%d[pos] = u%d(b%d, %d)[0]' %
+                                (i, i, i, ofs))
+                    continue
+                fmt += '%dx%s' % (ofs - end, var.MEMFMT)
+                end = ofs + var.sizeof()
+                targets.append('c%d[pos]' % i)
+            ns['u_%d' % n] = struct.Struct(fmt).unpack_from
+            ns['b_%d' % n] = items[0][2].buf
+            code.append('        %s, = u_%d(b_%d, %d)' %
+                        (', '.join(targets), n, n, start))
+        code.append('    return sample')
+        exec('\n'.join(code), ns)
+        self._bind = ns['bind']
+
+    def _next_chunk(self):
+        if self._chunk is not None:
+            self.full.put((self._chunk, self._pos))
+        try:
+            self._chunk = self.free.get_nowait()
+        except queue.Empty:
+            self._chunk = self._sample = None
+            return
+        self._sample = self._bind(*self._chunk)
+        self._pos = 0
+
+    def sample(self):
+        """Records the current values.  Call this after each cycle."""
+        if self._pos == self.chunk_size or self._sample is None:
+            self._next_chunk()
+            if self._sample is None:
+                self.dropped += 1
+                return
+        self._sample(self._pos, self.samples + self.dropped)
+        self._pos += 1
+        self.samples += 1
+
+    def _writer(self):
+        while True:
+            item = self.full.get()
+            if item is None:
+                return
+            chunk, count = item
+            for (fp, col) in zip(self.files, chunk):
+                fp.write(memoryview(col)[:count])
+            self.free.put(chunk)
+
+    def close(self):
+        """Writes the remaining samples and completes the files."""
+        if self._chunk is not None:
+            self.full.put((self._chunk, self._pos))
+            self._chunk = self._sample = None
+        self.full.put(None)
+        self._thread.join()
+        for (fp, (_, code, _)) in zip(self.files, self.columns):
+            fp.seek(0)
+            fp.write(npy_header(code, self.samples))
+            fp.close()
@@ -0,0 +1,116 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Python/ST language tools
+# Copyright (c) 2016 by the contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Cycle scheduling for the PLC simulation."""
+
+import time
+import collections
+
+
+def percentile(values, p):
+    """Return the p-th percentile of a sorted, nonempty sequence."""
+    return values[min(len(values) - 1, int(len(values) * p / 100.))]
+
+
+class Scheduler(object):
+    """Calls a cycle function at a fixed period.
+
+    Cycle start times are absolute deadlines on the monotonic clock, so the
+    period does not drift with execution time.  A cycle that finishes after
+    the next deadline is an overrun; the missed periods are skipped.  With a
+    cycle time of 0, cycles run back to back as fast as possible.
+    """
+
+    # number of recent cycles kept for the jitter statistics
+    WINDOW = 10000
+
+    def __init__(self, cycle_time=0.005):
+        self.cycle_time = cycle_time
+        self.cycles = 0
+        self.overruns = 0
+        self.started = None
+        self.running = False
+        # time spent in the cycle function (only with a fixed period)
+        self.busy = 0.0
+        # lateness of each recent cycle start against its deadline
+        self.jitter = collections.deque(maxlen=self.WINDOW)
+
+    def run(self, cycle, count=None):
+        """Run cycle() until count cycles are done, or forever."""
+        period = self.cycle_time
+        clock = time.monotonic
+        sleep = time.sleep
+        jitter = self.jitter
+        deadline = self.started = clock()
+        self.running = True
+        while self.running and (count is None or self.cycles < count):
+            if period:
+                start = clock()
+                jitter.append(start - deadline)
+            cycle()
+            self.cycles += 1
+            if not period:
+                continue
+            deadline += period
+            now = clock()
+            self.busy += now - start
+            if now > deadline:
+                self.overruns += 1
+                deadline += period * (1 + int((now - deadline) / period))
+            sleep(deadline - now)
+
+    def stop(self):
+        """Make run() return after the current cycle."""
+        self.running = False
+
+    def stats(self):
+        """Return the timing statistics as a dictionary."""
+        elapsed = time.monotonic() - self.started if self.started else 0.
+        values = sorted(self.jitter)
+        return {
+            'cycles': self.cycles,
+            'overruns': self.overruns,
+            'elapsed': elapsed,
+            'load': self.busy / elapsed if elapsed else 0.,
+            'jitter_p50': percentile(values, 50) if values else 0.,
+            'jitter_p99': percentile(values, 99) if values else 0.,
+            'jitter_max': values[-1] if values else 0.,
+        }
+
+    def report(self):
+        """Return a summary of the timing statistics."""
+        if not self.cycles:
+            return 'no cycles run'
+        elapsed = time.monotonic() - self.started
+        lines = ['%d cycles in %.2f s (%.3f ms/cycle), %d overruns' %
+                 (self.cycles, elapsed, 1000 * elapsed / self.cycles,
+                  self.overruns)]
+        if self.jitter:
+            values = sorted(self.jitter)
+            lines.append('jitter over last %d cycles: %s' % (
+                len(values), ', '.join(
+                    'p%d %.3f ms' % (p, 1000 * percentile(values, p))
+                    for p in (50, 90, 99))) +
+                ', max %.3f ms' % (1000 * values[-1]))
+        return '\n'.join(lines)
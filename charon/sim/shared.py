@@ -0,0 +1,79 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Python/ST language tools
+# Copyright (c) 2016 by the contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Access to the process image of a PLC in another process.
+
+The PLC must be started with a shared image (Memory.use_image(shared=name),
+or charon-sim --shared NAME).  Accesses go directly to the PLC's memory,
+without a Modbus round trip.  There is no synchronization with the PLC
+cycle: a value written while the PLC runs is seen by the cycle in progress
+or the next one, and a read may see a cycle half done.
+"""
+
+from multiprocessing import shared_memory
+
+from .st import AREA_SIZE, AREAS, parse_address
+
+
+class SharedImage(object):
+    """The %M, %I and %Q areas of a PLC with a shared image."""
+
+    def __init__(self, name):
+        try:
+            # Python >= 3.13: do not remove the block when we exit
+            self.shm = shared_memory.SharedMemory(name, track=False)
+        except TypeError:
+            self.shm = shared_memory.SharedMemory(name)
+            # XXX: the resource tracker would remove the block at exit
+            from multiprocessing import resource_tracker
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        self.buf = self.shm.buf
+
+    def area(self, name):
+        """Returns a memoryview of an area ('M', 'I' or 'Q')."""
+        start = (AREAS[name] - 1) * AREA_SIZE
+        return self.buf[start:start + AREA_SIZE]
+
+    def _locate(self, addr, size):
+        if isinstance(addr, str):
+            addr = parse_address(addr)
+        start = addr - AREA_SIZE
+        if not 0 <= start < len(AREAS) * AREA_SIZE or \
+           start % AREA_SIZE + size > AREA_SIZE:
+            raise RuntimeError('addressing outside of memory area')
+        return start
+
+    def read(self, addr, size):
+        """Reads from an address, given as number or like '%QB4'."""
+        start = self._locate(addr, size)
+        return self.buf[start:start + size].tobytes()
+
+    def write(self, addr, data):
+        """Writes to an address, given as number or like '%IB0'."""
+        start = self._locate(addr, len(data))
+        self.buf[start:start + len(data)] = data
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
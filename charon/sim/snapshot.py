@@ -0,0 +1,202 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Python/ST language tools
+# Copyright (c) 2016 by the contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Snapshots of the state of a PLC.
+
+A snapshot file consists of a header, a table of sections and the section
+data.  Each section starts at a multiple of the alignment given in the
+header, so that it can be used directly from an mmap of the file.
+
+Header:   magic, version, alignment, area size, dynamic memory used,
+          number of sections, layout digest
+Section:  kind (area, program or reals), area index, offset, size, name
+
+There is one section for each memory area (dynamic, %M, %I, %Q) and one for
+the variables of each program.  Since the memory layout has reals in single
+precision, the values of all reals are saved again as doubles in a last
+section.  Restoring requires the same project to be loaded, which is
+checked with a digest of the names, types and addresses of all variables.
+"""
+
+import os
+import mmap
+import struct
+import hashlib
+
+from .st import AREA_SIZE, AREAS, Struct, anyarray, real, find_programs
+
+MAGIC = b'CHARONSN'
+VERSION = 3
+HEADER = struct.Struct('<8sHHIIII16s')
+SECTION = struct.Struct('<BxxxIQQ64s')
+
+KIND_AREA = 1
+KIND_PROGRAM = 2
+KIND_REALS = 3
+
+ALIGN = mmap.ALLOCATIONGRANULARITY
+
+
+def type_name(dtype):
+    if issubclass(dtype, anyarray):
+        return '%s[%d..%d]' % (type_name(dtype.INNER), dtype.IMIN,
+                               dtype.IMIN + dtype.LENGTH - 1)
+    return dtype.__name__
+
+
+def variables(glob, mainfunc):
+    """Yields (name, value) for the variables in glob and in the programs
+    called by mainfunc, including members of structs, in a fixed order."""
+
+    def walk(name, value):
+        yield (name, value)
+        if isinstance(value, Struct):
+            for (member, var) in value.VARS:
+                yield from walk('%s.%s' % (name, member), value.__dict__[var])
+        elif isinstance(value, anyarray) and issubclass(value.INNER, Struct):
+            for (i, element) in enumerate(value.value, value.IMIN):
+                yield from walk('%s[%d]' % (name, i), element)
+
+    yield from walk('', glob)
+    for prog in sorted(find_programs(mainfunc),
+                       key=lambda prog: prog.func.__name__):
+        yield from walk(prog.func.__name__, prog.instance)
+
+
+def layout_digest(glob, mainfunc):
+    """Returns a digest of the names, types and addresses of the variables
+    in glob and in the programs called by mainfunc."""
+    digest = hashlib.md5()
+    for (name, value) in variables(glob, mainfunc):
+        line = '%s %s %s\n' % (name, type_name(type(value)), value.addr)
+        digest.update(line.encode())
+    return digest.digest()
+
+
+def reals(glob, mainfunc):
+    """Returns all real values, including array elements, in a fixed
+    order."""
+    values = []
+    for (_, value) in variables(glob, mainfunc):
+        if isinstance(value, real):
+            values.append(value)
+        elif isinstance(value, anyarray) and issubclass(value.INNER, real):
+            values.extend(value.value)
+    return values
+
+
+def save(filename, mem, glob, mainfunc):
+    """Writes the memory mem and the variables of mainfunc and the
+    programs it calls to a snapshot file."""
+    sections = [(KIND_AREA, area, '', mem.dump(area))
+                for area in range(1 + len(AREAS))]
+    for prog in find_programs(mainfunc):
+        sections.append((KIND_PROGRAM, 0, prog.func.__name__,
+                         prog.instance.mem_read()))
+    values = [value.value for value in reals(glob, mainfunc)]
+    sections.append((KIND_REALS, 0, '',
+                     struct.pack('<%dd' % len(values), *values)))
+    offset = HEADER.size + len(sections) * SECTION.size
+    table = []
+    for (kind, area, name, data) in sections:
+        offset = -(-offset // ALIGN) * ALIGN
+        table.append(SECTION.pack(kind, area, offset, len(data),
+                                  name.encode()))
+        offset += len(data)
+    with open(filename, 'wb') as fp:
+        fp.write(HEADER.pack(MAGIC, VERSION, 0, ALIGN, AREA_SIZE,
+                             mem.dyn_addr, len(sections),
+                             layout_digest(glob, mainfunc)))
+        fp.write(b''.join(table))
+        for ((kind, area, name, data), entry) in zip(sections, table):
+            fp.seek(SECTION.unpack(entry)[2])
+            fp.write(data)
+
+
+def read_sections(buf):
+    """Checks the header of a snapshot and returns (layout digest, list of
+    (kind, area, name, data)), where data are views into buf that must be
+    released."""
+    # no view may be left over when raising, or the mmap cannot be closed
+    with memoryview(buf) as view:
+        if len(view) < HEADER.size:
+            raise RuntimeError('not a snapshot file, or unsupported version')
+        magic, version, _, _, area_size, _, count, digest = \
+            HEADER.unpack_from(view)
+        if magic != MAGIC or version != VERSION:
+            raise RuntimeError('not a snapshot file, or unsupported version')
+        if area_size != AREA_SIZE:
+            raise RuntimeError('snapshot has a different memory area size')
+        if len(view) < HEADER.size + count * SECTION.size:
+            raise RuntimeError('snapshot file is truncated')
+        sections = []
+        for i in range(count):
+            kind, area, offset, size, name = SECTION.unpack_from(
+                view, HEADER.size + i * SECTION.size)
+            if offset + size > len(view):
+                for section in sections:
+                    section[3].release()
+                raise RuntimeError('snapshot file is truncated')
+            name = name.rstrip(b'\0').decode('ascii', 'replace')
+            sections.append((kind, area, name, view[offset:offset + size]))
+    return digest, sections
+
+
+def restore(filename, mem, glob, mainfunc):
+    """Restores the state saved by save() into mem and the variables of
+    mainfunc and the programs it calls."""
+    programs = dict((prog.func.__name__, prog)
+                    for prog in find_programs(mainfunc))
+    with open(filename, 'rb') as fp:
+        # an empty file cannot be mapped
+        if not os.fstat(fp.fileno()).st_size:
+            raise RuntimeError('not a snapshot file, or unsupported version')
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            digest, sections = read_sections(buf)
+            try:
+                if digest != layout_digest(glob, mainfunc):
+                    raise RuntimeError('snapshot does not match the memory '
+                                       'layout of the loaded project')
+                for (kind, area, name, data) in sections:
+                    if kind == KIND_AREA:
+                        mem.load(area, data)
+                for (kind, area, name, data) in sections:
+                    if kind == KIND_PROGRAM:
+                        if name not in programs:
+                            raise RuntimeError('snapshot contains unknown '
+                                               'program %s' % name)
+                        programs[name].instance.mem_write(0, data)
+                for (kind, area, name, data) in sections:
+                    if kind == KIND_REALS:
+                        values = reals(glob, mainfunc)
+                        if len(data) != 8 * len(values):
+                            raise RuntimeError('wrong number of reals in '
+                                               'snapshot')
+                        numbers = struct.unpack('<%dd' % len(values), data)
+                        for (value, number) in zip(values, numbers):
+                            value.assign(number)
+            finally:
+                # the mmap can only be closed without views into it
+                for section in sections:
+                    section[3].release()
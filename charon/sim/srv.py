@@ -22,6 +22,12 @@
 #
 # *****************************************************************************
 
+import sys
+import queue
+import asyncio
+import functools
+import collections
+from array import array
 from struct import pack, unpack, unpack_from
 import socketserver
 
@@ -30,79 +36,204 @@ class ModbusExc(Exception):
     pass
 
 
-class ConnectionHandler(socketserver.BaseRequestHandler):
+def swap_regs(data):
+    """Convert a block of 16-bit registers between host and network order."""
+    regs = array('H')
+    regs.frombytes(data)
+    if sys.byteorder == 'little':
+        regs.byteswap()
+    return regs.tobytes()
 
-    def handle(self):
-        sock = self.request
-        while True:
-            # read request
-            req = sock.recv(8)
-            if len(req) != 8:
-                return
-            tidpid, lgth, unit, func = unpack('>IHBB', req)
-            data = sock.recv(lgth - 2)
+
+def process_request(plc, func, data):
+    """Process one request on the PLC memory and return the response data
+    (without function code).
+    """
+    if func not in (3, 4, 6, 16):  # illegal function
+        raise ModbusExc(1)
+    addr, = unpack_from('>H', data)
+    addr = addr - 0x3000  # map from Beckhoff standard
+    if addr >= 0x1000:
+        # illegal data address
+        raise ModbusExc(2)
+    baddr = 2*addr + 0x10000  # map to byte address
+    if func in (3, 4):
+        # read data
+        nreg, = unpack('>H', data[2:])
+        # print("read %d regs from %d" % (nreg, addr))
+        try:
+            read = plc.read(baddr, 2*nreg)
+        except RuntimeError:
+            read = b''.join(plc.read(baddr+2*i, 2) for i in range(nreg))
+        # print("read data: %r" % read)
+        return pack('>B', 2*nreg) + swap_regs(read)
+    elif func == 6:
+        wdata = pack('H', *unpack('>H', data[2:4]))
+        # print("write 0x%04x to %d" % (wdata, addr))
+        plc.write(baddr, wdata)
+        return data
+    elif func == 16:
+        nreg, dbytes = unpack_from('>HB', data[2:])
+        if dbytes != 2*nreg or len(data) != 5 + dbytes:
+            raise ModbusExc(3)
+        wdata = swap_regs(data[5:])
+        # print("write %r to %d" % (wdata, addr))
+        plc.write(baddr, wdata)
+        return data[:4]
+
+
+def make_response(tidpid, unit, func, resp):
+    """Frame a response; resp is either the data or a ModbusExc."""
+    if isinstance(resp, ModbusExc):
+        return pack('>IHBBB', tidpid, 3, unit, func | 0x80, resp.args[0])
+    return pack('>IHBB', tidpid, 2 + len(resp), unit, func) + resp
+
+
+class RequestQueue(object):
+    """Requests waiting to be processed by the PLC between two cycles."""
+
+    def __init__(self):
+        self.queue = collections.deque()
+
+    def submit(self, func, data, callback):
+        """Queue a request; callback is called with the response data or
+        a ModbusExc from the PLC thread.
+        """
+        self.queue.append((func, data, callback))
+
+    def process(self, plc):
+        """Process all requests queued until now.
+
+        Reads are served from the state of the memory after the last cycle,
+        then writes are applied in order of arrival.  The responses are
+        sent after all requests are processed.
+        """
+        queue = self.queue
+        batch = [queue.popleft() for _ in range(len(queue))]
+        if not batch:
+            return
+        responses = [None] * len(batch)
+        reads = [i for (i, req) in enumerate(batch) if req[0] in (3, 4)]
+        others = [i for (i, req) in enumerate(batch) if req[0] not in (3, 4)]
+        for i in reads + others:
+            func, data, _ = batch[i]
             try:
-                resp = self.handle_req(lgth, func, data)
+                responses[i] = process_request(plc, func, data)
             except ModbusExc as e:
-                # print(e)
-                msg = pack('>IHBBB', tidpid, lgth, unit, func | 0x80,
-                           e.args[0])
+                responses[i] = e
             except Exception as e:
                 # print(e)
-                msg = pack('>IHBBB', tidpid, lgth, unit, func | 0x80, 1)
-            else:
-                msg = pack('>IHBB', tidpid, 2 + len(resp), unit, func) + resp
-            sock.sendall(msg)
-
-    def handle_req(self, lgth, func, data):
-        # decode request
-        if len(data) != lgth - 2:      # illegal data value
-            raise ModbusExc(3)
-        if func not in (3, 4, 6, 16):  # illegal function
-            raise ModbusExc(1)
-        addr, = unpack_from('>H', data)
-        addr = addr - 0x3000  # map from Beckhoff standard
-        if addr >= 0x1000:
-            # illegal data address
-            raise ModbusExc(2)
-        baddr = 2*addr + 0x10000  # map to byte address
-        with self.server.cond:
-            self.server.cond.wait()  # wait for go ahead for one round
-            if func in (3, 4):
-                # read data
-                nreg, = unpack('>H', data[2:])
-                # print("read %d regs from %d" % (nreg, addr))
-                try:
-                    read = self.server.plc.read(baddr, 2*nreg)
-                except RuntimeError:
-                    read = b''.join(self.server.plc.read(baddr+2*i, 2)
-                                    for i in range(nreg))
-                # print("read data: %r" % read)
-                return pack('>B', 2*nreg) + \
-                    b''.join(pack('>H', *unpack('H', read[2*i:2*i+2]))
-                             for i in range(nreg))
-            elif func == 6:
-                wdata = pack('H', *unpack('>H', data[2:4]))
-                # print("write 0x%04x to %d" % (wdata, addr))
-                self.server.plc.write(baddr, wdata)
-                return data
-            elif func == 16:
-                nreg, dbytes = unpack_from('>HB', data[2:])
-                assert dbytes == 2*nreg
-                wdata = b''.join(pack('H', *unpack('>H', data[2*i+5:2*i+7]))
-                                 for i in range(nreg))
-                # print("write %r to %d" % ([unpack('>H', data[2*i+5:2*i+7])
-                #                            for i in range(nreg)], addr))
-                self.server.plc.write(baddr, wdata)
-                return data[:4]
+                responses[i] = ModbusExc(1)
+        for ((_, _, callback), resp) in zip(batch, responses):
+            callback(resp)
+
+
+class ConnectionHandler(socketserver.BaseRequestHandler):
+
+    def setup(self):
+        # receives responses from the PLC thread
+        self.responses = queue.SimpleQueue()
+
+    def recv_exactly(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.request.recv(n - len(data))
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def handle(self):
+        while True:
+            # read MBAP header: transaction/protocol id, length, unit
+            header = self.recv_exactly(7)
+            if header is None:
+                return
+            tidpid, lgth, unit = unpack('>IHB', header)
+            if lgth < 2:
+                return
+            pdu = self.recv_exactly(lgth - 1)
+            if pdu is None:
+                return
+            self.server.requests.submit(pdu[0], pdu[1:], self.responses.put)
+            resp = self.responses.get()
+            self.request.sendall(make_response(tidpid, unit, pdu[0], resp))
 
 
 class Server(socketserver.ThreadingTCPServer):
+    """Serves each connection from its own thread.
+
+    Requests are handed to the PLC through a RequestQueue.
+    """
+
     allow_reuse_address = True
     daemon_threads = True
 
-    def __init__(self, plc, cond):
+    def __init__(self, plc, requests, port=5002):
         self.plc = plc
-        self.cond = cond
-        socketserver.ThreadingTCPServer.__init__(self, ('localhost', 5002),
+        self.requests = requests
+        socketserver.ThreadingTCPServer.__init__(self, ('localhost', port),
                                                  ConnectionHandler)
+
+
+class AsyncServer(object):
+    """Serves all connections from a single asyncio event loop.
+
+    Requests are handed to the PLC through a RequestQueue.
+    """
+
+    def __init__(self, plc, requests, port=5002):
+        self.plc = plc
+        self.requests = requests
+        self.loop = asyncio.new_event_loop()
+        self.server = self.loop.run_until_complete(asyncio.start_server(
+            self.handle, 'localhost', port, reuse_address=True))
+
+    def serve_forever(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            self.server.close()
+            # let the connection handlers finish before closing the loop
+            tasks = asyncio.all_tasks(self.loop)
+            for task in tasks:
+                task.cancel()
+            self.loop.run_until_complete(
+                asyncio.gather(*tasks, return_exceptions=True))
+            self.loop.run_until_complete(self.server.wait_closed())
+            self.loop.close()
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def _resolve(self, future, resp):
+        # called from the PLC thread
+        def set_result():
+            if not future.done():
+                future.set_result(resp)
+        self.loop.call_soon_threadsafe(set_result)
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                # read MBAP header: transaction/protocol id, length, unit
+                header = await reader.readexactly(7)
+                tidpid, lgth, unit = unpack('>IHB', header)
+                if lgth < 2:
+                    return
+                pdu = await reader.readexactly(lgth - 1)
+                future = self.loop.create_future()
+                self.requests.submit(pdu[0], pdu[1:],
+                                     functools.partial(self._resolve, future))
+                resp = await future
+                writer.write(make_response(tidpid, unit, pdu[0], resp))
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        except asyncio.CancelledError:
+            # cancelled at shutdown: end normally, since the stream protocol
+            # asks the task for its exception when it is done
+            pass
+        finally:
+            writer.close()
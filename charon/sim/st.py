@@ -22,20 +22,49 @@
 #
 # *****************************************************************************
 
+import re
 import sys
-import time
+import atexit
+import bisect
 import struct
-import itertools
+import contextlib
 import threading
 import collections
 
-from .srv import Server
+from .srv import Server, AsyncServer, RequestQueue
 from .util import NumProxy
+from .sched import Scheduler
+
+# size of each memory area (dyn, %M, %I, %Q)
+AREA_SIZE = 0x10000
+# index of the located memory areas
+AREAS = {'M': 1, 'I': 2, 'Q': 3}
+
+
+def parse_address(spec):
+    """Convert a location like %MB4 into an address."""
+    if spec[:1] == '%' and spec[1:2] in AREAS and spec[2:3] == 'B' and \
+       spec[3:].isdigit():
+        return AREAS[spec[1]] * AREA_SIZE + int(spec[3:])
+    raise RuntimeError('addr spec %s not supported' % spec)
+
+
+class Allocation(object):
+    """An entry in the allocation index of Memory."""
+
+    __slots__ = ('start', 'end', 'obj', 'parent')
+
+    def __init__(self, start, end, obj, parent):
+        self.start = start
+        self.end = end
+        self.obj = obj
+        # innermost allocation enclosing this one, or None
+        self.parent = parent
 
 
 class Memory(object):
-    # XXX: not multi-PLC-safe!
-    # Allocates addresses for variables.
+    # Allocates addresses for variables.  Each PLC has its own memory; the
+    # one used for new variables is selected with activate().
 
     def __init__(self):
         # dyn is at 0x00000
@@ -43,57 +72,314 @@ class Memory(object):
         # %I* is at 0x20000
         # %Q* is at 0x30000
         self.dyn_addr = 0
+        # Index of all allocations, sorted by start address, then by
+        # descending end address and newest first, so that enclosing
+        # allocations come before the allocations they contain.
+        self.alloc_starts = []
         self.allocations = []
-        self.allocations_sorted = False
+        # Set when two allocations overlap partly (located variables may);
+        # then the allocations are not nested and get() has to scan them.
+        self.overlapping = False
+        # If not None, a flat process image: one buffer per memory area,
+        # which is where all scalar values are stored.
+        self.image = None
+        # shared memory block holding the located areas of the image
+        self.shm = None
+        # If not None, write tracking is on: maps start addresses of the
+        # ranges written since the last take_dirty() to their size.
+        self.dirty = None
+
+    def use_image(self, shared=None):
+        """Store values in a flat process image instead of Python objects.
+
+        If shared is given, the %M, %I and %Q areas are put, in this order,
+        into a new shared memory block with that name, so that other
+        processes can access them directly (see charon.sim.shared).  The
+        block is removed when the process exits.
+
+        Must be called before any variable is allocated.
+        """
+        if self.dyn_addr or self.allocations:
+            raise RuntimeError('process image must be set up before '
+                               'allocating variables')
+        self.image = [memoryview(bytearray(AREA_SIZE))]
+        if shared is None:
+            self.image.extend(memoryview(bytearray(AREA_SIZE))
+                              for _ in AREAS)
+            return
+        from multiprocessing import shared_memory
+        self.shm = shared_memory.SharedMemory(shared, create=True,
+                                              size=len(AREAS) * AREA_SIZE)
+        atexit.register(self.shm.unlink)
+        buf = self.shm.buf
+        self.image.extend(buf[i * AREA_SIZE:(i + 1) * AREA_SIZE]
+                          for i in range(len(AREAS)))
+
+    def track_writes(self, enabled=True):
+        """Switch tracking of the written address ranges on or off."""
+        self.dirty = {} if enabled else None
+
+    def mark(self, addr, size):
+        """Record a write of size bytes at addr, if tracking is on."""
+        dirty = self.dirty
+        if dirty is not None and dirty.get(addr, 0) < size:
+            dirty[addr] = size
+
+    def take_dirty(self):
+        """Return the ranges written since the last call, as a sorted list
+        of (addr, size) with overlapping and adjacent ranges merged.
+
+        Writes by other processes to a shared image are not seen.
+        """
+        dirty = self.dirty
+        if dirty is None:
+            raise RuntimeError('write tracking is not enabled')
+        # values look up the dict through the memory on every write
+        self.dirty = {}
+        ranges = []
+        start = end = -1
+        for addr in sorted(dirty):
+            if addr > end:
+                if end >= 0:
+                    ranges.append((start, end - start))
+                start = addr
+                end = addr + dirty[addr]
+            elif addr + dirty[addr] > end:
+                end = addr + dirty[addr]
+        if end >= 0:
+            ranges.append((start, end - start))
+        return ranges
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Makes this the memory returned by memory() in this thread while
+        the context is active."""
+        previous = getattr(_context, 'mem', None)
+        _context.mem = self
+        try:
+            yield self
+        finally:
+            _context.mem = previous
 
     def new(self, size):
         addr = self.dyn_addr
         self.dyn_addr += size
+        if self.image is not None and self.dyn_addr > AREA_SIZE:
+            raise RuntimeError('out of dynamic memory')
         return addr
 
+    def locate(self, addr, size=0):
+        """Return the image buffer and offset in it for an address."""
+        area, offset = divmod(addr, AREA_SIZE)
+        if not 0 <= area < len(self.image) or offset + size > AREA_SIZE:
+            raise RuntimeError('addressing outside of memory area')
+        return (self.image[area], offset)
+
+    @staticmethod
+    def _contains(alloc, addr, end):
+        # an empty range at the end of an allocation belongs to the next one
+        return alloc.start <= addr and end <= alloc.end and \
+            (addr < alloc.end or alloc.start == alloc.end)
+
+    def _enclosing(self, i, addr, end):
+        """Return the innermost allocation before index i that contains the
+        range addr..end, or None.
+        """
+        contains = self._contains
+        if self.overlapping:
+            # smallest of all allocations containing the range
+            found = None
+            for alloc in reversed(self.allocations[:i]):
+                if contains(alloc, addr, end) and (
+                        found is None or
+                        alloc.end - alloc.start < found.end - found.start):
+                    found = alloc
+            return found
+        # Any allocation containing the range is either the one right
+        # before i or one of its ancestors (allocations are nested).
+        alloc = self.allocations[i - 1] if i else None
+        while alloc is not None and not contains(alloc, addr, end):
+            alloc = alloc.parent
+        return alloc
+
     def map(self, addr, obj):
         """Map a new allocation."""
-        self.allocations.append((obj.sizeof(), addr, obj))
-        self.allocations_sorted = False
+        end = addr + obj.sizeof()
+        starts, allocs = self.alloc_starts, self.allocations
+        i = bisect.bisect_left(starts, addr)
+        while i < len(allocs) and allocs[i].start == addr and \
+                allocs[i].end > end:
+            i += 1
+        parent = self._enclosing(i, addr, end)
+        new = Allocation(addr, end, obj, parent)
+        # allocations that start before the new one and end inside it
+        alloc = allocs[i - 1] if i else None
+        while alloc is not None:
+            if alloc.start < addr < alloc.end < end:
+                self.overlapping = True
+            alloc = alloc.parent
+        # Members are usually mapped before their container: adopt all
+        # allocations directly inside the new one.
+        j = i
+        while j < len(allocs) and allocs[j].start < end:
+            child = allocs[j]
+            if child.end > end:
+                self.overlapping = True
+            elif child.parent is parent:
+                child.parent = new
+            # skip the child's own members
+            j = max(j + 1, bisect.bisect_left(starts, child.end))
+        starts.insert(i, addr)
+        allocs.insert(i, new)
 
     def get(self, addr, size):
         """Return the object that addr belongs to, and the offset in it,
         if there are at least size bytes left.
+
+        If several nested objects qualify, the innermost one is returned.
         """
-        if not self.allocations_sorted:
-            self.allocations.sort(key=lambda x: x[1])
-            self.allocations_sorted = True
-        for (osize, oaddr, obj) in self.allocations:
-            if oaddr <= addr and addr + size <= oaddr + osize:
-                return (obj, addr - oaddr)
-        raise RuntimeError('no value or addressing across value boundary')
+        i = bisect.bisect_right(self.alloc_starts, addr)
+        alloc = self._enclosing(i, addr, addr + size)
+        if alloc is None:
+            raise RuntimeError('no value or addressing across value boundary')
+        return (alloc.obj, addr - alloc.start)
+
+    def dump(self, area):
+        """Return the contents of a memory area (index into AREAS)."""
+        return self.read_block(area * AREA_SIZE, AREA_SIZE)
+
+    def read_block(self, addr, size):
+        """Read memory that may span several variables.  Bytes that belong
+        to no variable read as zero."""
+        try:
+            return self.read(addr, size)
+        except RuntimeError:
+            pass
+        data = bytearray(size)
+        end = addr + size
+        i = bisect.bisect_left(self.alloc_starts, addr)
+        # top-level allocations overlapping the block: the one containing
+        # the start, then all starting in the block
+        overlapping = []
+        if self.overlapping:
+            overlapping.extend(alloc for alloc in self.allocations[:i]
+                               if alloc.parent is None and alloc.end > addr)
+        elif i:
+            alloc = self.allocations[i - 1]
+            while alloc.parent is not None:
+                alloc = alloc.parent
+            if alloc.end > addr:
+                overlapping.append(alloc)
+        for alloc in self.allocations[i:]:
+            if alloc.start >= end:
+                break
+            if alloc.parent is None:
+                overlapping.append(alloc)
+        for alloc in overlapping:
+            start, stop = max(alloc.start, addr), min(alloc.end, end)
+            data[start-addr:stop-addr] = \
+                alloc.obj.mem_slice(start - alloc.start, stop - start)
+        return bytes(data)
+
+    def load(self, area, data):
+        """Set the contents of a memory area, as returned by dump()."""
+        if len(data) != AREA_SIZE:
+            raise RuntimeError('wrong size of memory area data')
+        self.mark(area * AREA_SIZE, AREA_SIZE)
+        if self.image is not None:
+            self.image[area][:] = data
+            return
+        data = memoryview(data)
+        base = area * AREA_SIZE
+        i = bisect.bisect_left(self.alloc_starts, base)
+        for alloc in self.allocations[i:]:
+            if alloc.start >= base + AREA_SIZE:
+                break
+            if alloc.parent is None and alloc.end > alloc.start:
+                end = min(alloc.end, base + AREA_SIZE)
+                alloc.obj.mem_write(0, data[alloc.start-base:end-base])
 
     def read(self, addr, size):
         """Read memory."""
+        if self.image is not None:
+            (buf, offset) = self.locate(addr, size)
+            return buf[offset:offset+size].tobytes()
         (obj, offset) = self.get(addr, size)
-        return obj.mem_read()[offset:offset+size]
+        return obj.mem_slice(offset, size)
 
     def write(self, addr, data):
         """Write memory."""
+        if self.image is not None:
+            (buf, offset) = self.locate(addr, len(data))
+            buf[offset:offset+len(data)] = data
+            self.mark(addr, len(data))
+            return
         (obj, offset) = self.get(addr, len(data))
         obj.mem_write(offset, data)
+        self.mark(addr, len(data))
 
 
+# the memory used if no other one is activated
 mem = Memory()
+_context = threading.local()
+
+
+def memory():
+    """Returns the currently active memory."""
+    active = getattr(_context, 'mem', None)
+    return mem if active is None else active
 
 
 class Value(object):
     """Represents a place in memory for a variable."""
 
+    __slots__ = ('addr',)
+
+    # Accessors for the value if it is kept in a buffer (only for scalars).
+    _image_get = _image_set = None
+    # Struct format for the value in a buffer outside of a process image,
+    # if different from the memory layout (see scalararray).
+    BUFFMT = None
+
     @classmethod
     def alloc(cls, value, at=None):
         """Allocates an address for the value (if not given)."""
+        mem = memory()
         if at is None:
             at = mem.new(cls.sizeof())
-        val = cls(value, at)
+        if mem.image is not None and cls._image_get is not None:
+            val = cls.image_type().view(at, *mem.locate(at, cls.sizeof()))
+            val.assign(value)
+        else:
+            val = cls(value, at)
         mem.map(at, val)
         return val
 
+    @classmethod
+    def image_type(cls):
+        """Returns the variant of this type that is backed by a buffer."""
+        try:
+            return _image_types[cls]
+        except KeyError:
+            itype = _image_types[cls] = type(cls.__name__, (ImageValue, cls), {
+                '__slots__': ('buf', 'ofs'),
+                'value': property(cls._image_get, cls._image_set)})
+            return itype
+
+    @classmethod
+    def buffer_type(cls):
+        """Returns the variant of this type that is backed by a buffer
+        outside of a process image."""
+        if cls.BUFFMT is None:
+            return cls.image_type()
+        try:
+            return _image_types[cls, cls.BUFFMT]
+        except KeyError:
+            btype = _image_types[cls, cls.BUFFMT] = type(
+                cls.__name__, (cls.image_type(),), {
+                    '__slots__': (), 'MEMFMT': cls.BUFFMT})
+            return btype
+
     @classmethod
     def default(cls, at=None):
         """Allocates a value with a default value."""
@@ -113,22 +399,51 @@ class Value(object):
 
     def __init__(self, value, addr):
         self.addr = addr
+        self.value = None
         self.assign(value)
 
     def __repr__(self):
         return repr(self.value)
 
     def assign(self, value):
-        self.value = self.__class__.unwrap(value)
+        value = self.__class__.unwrap(value)
+        # writes are tracked in the active memory, the one of the PLC
+        mem = memory()
+        if mem.dirty is not None and value != self.value:
+            mem.mark(self.addr, self.sizeof())
+        self.value = value
 
     def mem_read(self):
         raise NotImplementedError
 
+    def mem_slice(self, offset, size):
+        """Reads size bytes at offset from the memory layout."""
+        return self.mem_read()[offset:offset+size]
+
     def mem_write(self, offset, data):
         raise NotImplementedError
 
 
+class ImageValue(object):
+    """Mixin for scalar values that live at an offset in a buffer."""
+
+    __slots__ = ()
+
+    @classmethod
+    def view(cls, addr, buf, ofs):
+        """Creates a value at addr that is stored in buf at ofs."""
+        self = cls.__new__(cls)
+        self.addr = addr
+        self.buf = buf
+        self.ofs = ofs
+        return self
+
+
+_image_types = {}
+
+
 class Integral(NumProxy, Value):
+    __slots__ = ('value',)
     DEFAULT = 0
     WIDTH = 0
     SIGNED = False
@@ -165,34 +480,51 @@ class Integral(NumProxy, Value):
             raise RuntimeError('partial number write')
         self.value, = struct.unpack(self.MEMFMT, data)
 
+    def _image_get(self):
+        return struct.unpack_from(self.MEMFMT, self.buf, self.ofs)[0]
+
+    def _image_set(self, value):
+        # the buffer only holds integers; other numbers are truncated
+        if not isinstance(value, int):
+            value = int(value)
+        struct.pack_into(self.MEMFMT, self.buf, self.ofs, value)
+
     def __getitem__(self, i):
         # Bit access: a[[i]]
         return (self.value >> i[0]) & 1
 
     def __setitem__(self, i, val):
         mask = ~(1 << i[0])
-        self.value = (self.value & mask) | ((val & 1) << i[0])
+        value = (self.value & mask) | ((val & 1) << i[0])
+        mem = memory()
+        if mem.dirty is not None and value != self.value:
+            mem.mark(self.addr, self.sizeof())
+        self.value = value
 
 
 class byte(Integral):
+    __slots__ = ()
     WIDTH = 8
     SIGNED = False
     MEMFMT = 'B'
 
 
 class word(Integral):
+    __slots__ = ()
     WIDTH = 16
     SIGNED = False
     MEMFMT = 'H'
 
 
 class dword(Integral):
+    __slots__ = ()
     WIDTH = 32
     SIGNED = False
     MEMFMT = 'I'
 
 
 class bool(Integral):
+    __slots__ = ()
     WIDTH = 1
     SIGNED = False
     MEMFMT = 'B'
@@ -203,24 +535,38 @@ class bool(Integral):
 
 
 class real(NumProxy, Value):
+    __slots__ = ('value',)
     DEFAULT = 0.0
+    MEMFMT = 'f'
+    # keep the precision of plain values in arrays without a process image
+    BUFFMT = 'd'
 
     @classmethod
     def sizeof(cls):
         return 4
 
     def mem_read(self):
-        return struct.pack('f', self.value)
+        return struct.pack(self.MEMFMT, self.value)
 
     def mem_write(self, offset, data):
         if offset != 0:
             raise RuntimeError('partial number write')
-        self.value, = struct.unpack('f', data)
+        self.value, = struct.unpack(self.MEMFMT, data)
+
+    def _image_get(self):
+        return struct.unpack_from(self.MEMFMT, self.buf, self.ofs)[0]
+
+    def _image_set(self, value):
+        struct.pack_into(self.MEMFMT, self.buf, self.ofs, value)
 
 
 class anystring(Value):
+    __slots__ = ('value',)
     SLEN = 0
     DEFAULT = ''
+    # one byte per character, so that the length limit is the same in
+    # memory and any bytes written to a string area can be read back
+    ENCODING = 'latin-1'
 
     @classmethod
     def sizeof(cls):
@@ -232,25 +578,42 @@ class anystring(Value):
             value = value.value
         if len(value) > cls.SLEN:
             raise RuntimeError('string too long (%d chars max)' % cls.SLEN)
+        try:
+            value.encode(cls.ENCODING)
+        except UnicodeEncodeError:
+            raise RuntimeError('string has characters not in %s' %
+                               cls.ENCODING)
         return value
 
     def mem_read(self):
-        return self.value.encode() + b'\0' * (self.SLEN - len(self.value))
+        return self.value.encode(self.ENCODING) + \
+            b'\0' * (self.SLEN - len(self.value))
 
     def mem_write(self, offset, data):
         if offset != 0:
             raise RuntimeError('partial string write')
-        self.value = data.split('\0', 1)[0]
+        self.value = bytes(data).split(b'\0', 1)[0].decode(self.ENCODING)
+
+    def _image_get(self):
+        data = self.buf[self.ofs:self.ofs + self.SLEN].tobytes()
+        return data.split(b'\0', 1)[0].decode(self.ENCODING)
+
+    def _image_set(self, value):
+        data = value.encode(self.ENCODING)
+        self.buf[self.ofs:self.ofs + self.SLEN] = \
+            data + b'\0' * (self.SLEN - len(data))
 
     def __len__(self):
         return self.value.__len__()
 
 
 def string(slen):
-    return type('string_%d' % slen, (anystring,), dict(SLEN=slen))
+    return type('string_%d' % slen, (anystring,), dict(__slots__=(),
+                                                       SLEN=slen))
 
 
 class anyarray(Value):
+    __slots__ = ('value',)
     LENGTH = 0
     IMIN = 0
     INNER = None
@@ -295,23 +658,113 @@ class anyarray(Value):
         return b''.join(v.mem_read() for v in self.value)
 
     def mem_write(self, offset, data):
+        if offset + len(data) > self.sizeof():
+            raise RuntimeError('write beyond end of array')
+        data = memoryview(data)
         step = self.INNER.sizeof()
-        if offset % step != 0:
-            raise RuntimeError('partial array element write')
-        if len(data) % step != 0:
-            raise RuntimeError('partial array element write')
-        i = offset // step
-        while data:
-            d, data = data[:step], data[step:]
-            self.value[i].mem_write(0, d)
-            i += 1
+        elements = self.value
+        pos, end = 0, len(data)
+        while pos < end:
+            i, elofs = divmod(offset + pos, step)
+            n = min(step - elofs, end - pos)
+            elements[i].mem_write(elofs, data[pos:pos+n])
+            pos += n
+
+
+class scalararray(anyarray):
+    """Array of scalars, stored in a single buffer.
+
+    Element values are only created (as views into the buffer) on access,
+    so each access gives a new object.  Views of the same element compare
+    equal and all see its current value.  Outside of a process image, reals
+    are stored as doubles.
+    """
+
+    # etype is the type of the element views, step their size in buf
+    __slots__ = ('buf', 'ofs', 'etype', 'step')
+
+    def __init__(self, value, addr):
+        self.addr = addr
+        mem = memory()
+        if mem.image is not None and addr is not None:
+            self.etype = self.INNER.image_type()
+            self.step = self.INNER.sizeof()
+            self.buf, self.ofs = mem.locate(addr, self.sizeof())
+        else:
+            self.etype = self.INNER.buffer_type()
+            self.step = self.INNER.sizeof() if self.INNER.BUFFMT is None \
+                else struct.calcsize(self.INNER.BUFFMT)
+            self.buf, self.ofs = \
+                memoryview(bytearray(self.LENGTH * self.step)), 0
+        value = self.__class__.unwrap(value)
+        if len(value) > self.LENGTH:
+            raise RuntimeError('too many values in array assignment')
+        if self.LENGTH:
+            # fill with the default in one go, then set the given values
+            self._element(0).assign(self.INNER.DEFAULT)
+            self.buf[self.ofs:self.ofs + self.LENGTH * self.step] = \
+                self.buf[self.ofs:self.ofs + self.step].tobytes() * self.LENGTH
+        for (i, val) in enumerate(value):
+            self._element(i).assign(val)
+
+    def _element(self, i):
+        return self.etype.view(
+            self.addr + i*self.INNER.sizeof() if self.addr is not None
+            else None, self.buf, self.ofs + i*self.step)
+
+    @property
+    def value(self):
+        return [self._element(i) for i in range(self.LENGTH)]
+
+    def __getitem__(self, i):
+        if not self.IMIN <= i < self.IMIN + self.LENGTH:
+            raise RuntimeError('array access out of range')
+        return self._element(i - self.IMIN)
+
+    def __setitem__(self, i, val):
+        if not self.IMIN <= i < self.IMIN + self.LENGTH:
+            raise RuntimeError('array access out of range')
+        self._element(i - self.IMIN).assign(val)
+
+    def mem_read(self):
+        return self.mem_slice(0, self.sizeof())
+
+    def mem_slice(self, offset, size):
+        size = min(size, self.sizeof() - offset)
+        if self.step == self.INNER.sizeof():
+            start = self.ofs + offset
+            return self.buf[start:start + size].tobytes()
+        # convert the elements in the range to the memory layout
+        elsize = self.INNER.sizeof()
+        first, last = offset // elsize, -(-(offset + size) // elsize)
+        values = struct.unpack_from('%d%s' % (last - first, self.etype.MEMFMT),
+                                    self.buf, self.ofs + first * self.step)
+        data = struct.pack('%d%s' % (len(values), self.INNER.MEMFMT), *values)
+        start = offset - first * elsize
+        return data[start:start + size]
+
+    def mem_write(self, offset, data):
+        if offset + len(data) > self.sizeof():
+            raise RuntimeError('write beyond end of array')
+        if self.step == self.INNER.sizeof():
+            self.buf[self.ofs + offset:self.ofs + offset + len(data)] = data
+        else:
+            elsize = self.INNER.sizeof()
+            if offset % elsize or len(data) % elsize:
+                raise RuntimeError('partial number write')
+            n = len(data) // elsize
+            values = struct.unpack('%d%s' % (n, self.INNER.MEMFMT), data)
+            struct.pack_into('%d%s' % (n, self.etype.MEMFMT), self.buf,
+                             self.ofs + offset // elsize * self.step, *values)
 
 
 def array(innertype, imin, imax):
     length = imax - imin + 1
-    return type('array_%d' % length, (anyarray,), dict(LENGTH=length,
-                                                       IMIN=imin,
-                                                       INNER=innertype))
+    base = anyarray if innertype._image_get is None else scalararray
+    return type('array_%d' % length, (base,), dict(__slots__=(),
+                                                   LENGTH=length,
+                                                   IMIN=imin,
+                                                   INNER=innertype))
 
 
 class Var(object):
@@ -322,14 +775,7 @@ class Var(object):
         self.default = default if default is not None else dtype.DEFAULT
         self.at = None  # XXX
         if at is not None:
-            if at.startswith('%MB'):
-                self.at = int(at[3:]) + 0x10000
-            elif at.startswith('%IB'):
-                self.at = int(at[3:]) + 0x20000
-            elif at.startswith('%QB'):
-                self.at = int(at[3:]) + 0x30000
-            else:
-                raise RuntimeError('addr spec %s not supported' % at)
+            self.at = parse_address(at)
 
     def __get__(self, obj, obj_class):
         if obj is None:
@@ -350,11 +796,16 @@ class StructMeta(type):
     def __init__(cls, name, bases, attrs):
         cls.VARS = []
         cls.OFFSET = {}
+        # (offset, size, var) of the variables in order, and their offsets
+        cls.FIELDS = []
+        cls.OFFSETS = []
         size = 0
         for (name, var) in attrs.items():
             if isinstance(var, Var):
                 cls.VARS.append((name, var))
                 cls.OFFSET[name] = size
+                cls.FIELDS.append((size, var.dtype.sizeof(), var))
+                cls.OFFSETS.append(size)
                 # XXX alignment!
                 size += var.dtype.sizeof()
         cls.SIZE = size
@@ -397,21 +848,22 @@ class Struct(Value, metaclass=StructMeta):
         return b''.join(self.__dict__[var].mem_read() for (_, var) in self.VARS)
 
     def mem_write(self, offset, data):
-        for (name, var) in self.VARS:
-            ofs = self.OFFSET[name]
-            size = var.dtype.sizeof()
-            if ofs <= offset < ofs + size:
-                # at least parial write
-                # overlap
-                o = min(ofs + size - offset, len(data))
-                d, data = data[:o], data[o:]
-                # (partial) write
-                self.__dict__[var].mem_write(offset - ofs, d)
-                if data:
-                    self.mem_write(offset + o, data)
-                return
-        raise RuntimeError("failed to write %d bytes @ offset %d" %
-                           (len(data), offset))
+        if offset < 0 or offset + len(data) > self.SIZE:
+            raise RuntimeError("failed to write %d bytes @ offset %d" %
+                               (len(data), offset))
+        data = memoryview(data)
+        fields = self.FIELDS
+        values = self.__dict__
+        # first variable affected by the write
+        i = bisect.bisect_right(self.OFFSETS, offset) - 1
+        pos, end = 0, len(data)
+        while pos < end:
+            (ofs, size, var) = fields[i]
+            # (partial) write
+            n = min(ofs + size - offset - pos, end - pos)
+            values[var].mem_write(offset + pos - ofs, data[pos:pos+n])
+            pos += n
+            i += 1
 
 
 class Globals(Struct):
@@ -421,36 +873,194 @@ class Globals(Struct):
 def program(**pvars):
     def deco(func):
         var_struct = type('%s_vars' % func.__name__, (Struct,), pvars)
-        instance = var_struct()
+        return make_program(func, var_struct())
+    return deco
 
-        def new_func():
-            func(instance)
 
-        new_func.is_program = True
-        return new_func
-    return deco
+def make_program(func, instance):
+    """Returns the callable for a program implemented by func, with its
+    variables in instance."""
+    def new_func():
+        func(instance)
+
+    new_func.is_program = True
+    new_func.func = func
+    new_func.instance = instance
+    return new_func
+
 
+def find_programs(mainfunc):
+    """Returns a list of mainfunc and all programs it can call."""
+    programs = []
+    todo = [mainfunc]
+    while todo:
+        prog = todo.pop()
+        if prog in programs:
+            continue
+        programs.append(prog)
+        todo.extend(obj for obj in list(prog.func.__globals__.values())
+                    if getattr(obj, 'is_program', False))
+    return programs
 
-def run(glob, mainfunc):
+
+def check_main(glob, mainfunc):
     if not isinstance(glob, Globals):
         raise RuntimeError('globals must be a Globals instance')
     if not getattr(mainfunc, 'is_program', False):
         raise RuntimeError('main function must be a program')
 
-    cond = threading.Condition()
-    srv = Server(mem, cond)
-    threading.Thread(target=srv.serve_forever).start()
 
-    print('Starting main PLC loop.')
+def lookup(glob, name):
+    """Find a variable by name, like 'Devices[1].Name'."""
+    obj = glob
+    for part in re.findall(r'\.?(\w+)|\[(-?\d+)\]', name):
+        if part[0]:
+            obj = getattr(obj, part[0])
+        else:
+            obj = obj[int(part[1])]
+    if not isinstance(obj, Value):
+        raise RuntimeError('%s is not a variable' % name)
+    return obj
+
+
+def simulate(glob, mainfunc, cycles, inputs=(), trace=(), compiled=False,
+             profiler=None, hooks=()):
+    """Run the PLC for a number of cycles as fast as possible, without
+    a server.
+
+    inputs is an iterable of (cycle, address, data) tuples; the data is
+    written to memory before that cycle.  The address is either a
+    number or a location like '%IB0'.  trace is a list of names of scalar
+    variables whose values are recorded after each cycle.
+
+    Returns (image, traces), where image maps area names to the final
+    contents of the %M, %I and %Q areas and traces maps each traced name
+    to the list of its values.
+
+    If compiled is true, the programs are compiled first (see
+    charon.sim.compiler).  If a Profiler is given, the cycles are profiled
+    with it.  hooks are called without arguments after each cycle.
+
+    The PLC's memory must be the active one (see Memory.activate).
+    """
+    check_main(glob, mainfunc)
+    mem = memory()
+    if compiled:
+        from .compiler import compile_program
+        mainfunc = compile_program(mainfunc)
+    schedule = collections.deque(sorted(
+        ((cycle, parse_address(addr) if isinstance(addr, str) else addr,
+          data) for (cycle, addr, data) in inputs),
+        key=lambda item: item[0]))
+    traced = [(name, lookup(glob, name), []) for name in trace]
+    if profiler is not None:
+        mainfunc = profiler.start(mainfunc)
+    try:
+        for i in range(cycles):
+            while schedule and schedule[0][0] <= i:
+                _, addr, data = schedule.popleft()
+                mem.write(addr, data)
+            mainfunc()
+            for hook in hooks:
+                hook()
+            for (_, var, values) in traced:
+                values.append(var.value)
+    finally:
+        if profiler is not None:
+            profiler.stop()
+    image = dict((name, mem.dump(area)) for (name, area) in AREAS.items())
+    return image, dict((name, values) for (name, _, values) in traced)
+
+
+class PLC(object):
+    """A simulated PLC: its memory, globals, main program and Modbus port."""
+
+    def __init__(self, glob, mainfunc, mem, port=5002, name=None):
+        check_main(glob, mainfunc)
+        self.glob = glob
+        self.mainfunc = mainfunc
+        self.mem = mem
+        self.port = port
+        self.name = name or 'PLC@%d' % port
+        self.requests = RequestQueue()
+        self.server = None
+        # called without arguments after each cycle, e.g. to record values
+        self.hooks = []
+
+    def __repr__(self):
+        return '<%s>' % self.name
+
+    def start_server(self, server='threaded'):
+        """Starts the Modbus server for this PLC in a new thread."""
+        if server == 'asyncio':
+            self.server = AsyncServer(self.mem, self.requests, self.port)
+        elif server == 'threaded':
+            self.server = Server(self.mem, self.requests, self.port)
+        else:
+            raise RuntimeError('unknown server type: %s' % server)
+        threading.Thread(target=self.server.serve_forever).start()
+
+    def cycle(self):
+        """Runs one PLC cycle and processes pending Modbus requests."""
+        with self.mem.activate():
+            self.mainfunc()
+            for hook in self.hooks:
+                hook()
+            self.requests.process(self.mem)
+
+
+def load(filename, port=5002, image=False, shared=None):
+    """Loads a PLC project (with globals g and main program Main) into a
+    new memory.  image and shared are passed to Memory.use_image()."""
+    plc_mem = Memory()
+    if image or shared:
+        plc_mem.use_image(shared)
+    ns = {}
+    with plc_mem.activate():
+        # compile with the file name, so that the compiler can find the source
+        exec(compile(open(filename).read(), filename, 'exec'), ns)
+    return PLC(ns['g'], ns['Main'], plc_mem, port, filename)
+
+
+def run(glob, mainfunc, server='threaded', cycle_time=0.005, compiled=False,
+        profiler=None, port=5002):
+    """Runs the PLC whose memory is active, serving Modbus on port."""
+    run_plcs([PLC(glob, mainfunc, memory(), port)], server, cycle_time,
+             compiled, profiler)
+
+
+def run_plcs(plcs, server='threaded', cycle_time=0.005, compiled=False,
+             profiler=None):
+    """Runs several PLCs with a shared scheduler: each cycle runs one cycle
+    of every PLC in turn.  Each PLC has its own Modbus server."""
+    for plc in plcs:
+        if compiled:
+            from .compiler import compile_program
+            with plc.mem.activate():
+                plc.mainfunc = compile_program(plc.mainfunc)
+        if profiler is not None:
+            plc.mainfunc = profiler.start(plc.mainfunc)
+        plc.start_server(server)
+
+    sched = Scheduler(cycle_time)
+
+    def cycle():
+        if sched.cycles % 100 == 0:
+            print('\r%10d cycles' % sched.cycles, end='')
+            sys.stdout.flush()
+        for plc in plcs:
+            plc.cycle()
+
+    print('Starting main PLC loop with %d PLC(s).' % len(plcs))
     try:
-        for i in itertools.count():
-            if i % 100 == 0:
-                print('\r%10d cycles' % i, end='')
-                sys.stdout.flush()
-            with cond:
-                mainfunc()
-                cond.notify()
-            time.sleep(.005)
+        sched.run(cycle)
     except KeyboardInterrupt:
-        srv.shutdown()
+        if profiler is not None:
+            profiler.stop()
+        for plc in plcs:
+            plc.server.shutdown()
+        print()
+        print(sched.report())
+        if profiler is not None:
+            print(profiler.report())
         sys.exit(0)
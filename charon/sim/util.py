@@ -24,6 +24,7 @@
 
 
 class NumProxy:
+    __slots__ = ()
 
     def __add__(self, other):
         if isinstance(other, NumProxy):
@@ -75,6 +76,36 @@ class NumProxy:
             other = other.value
         return self.value.__lshift__(other)
 
+    def __radd__(self, other):
+        return other + self.value
+
+    def __rsub__(self, other):
+        return other - self.value
+
+    def __rmul__(self, other):
+        return other * self.value
+
+    def __rfloordiv__(self, other):
+        return other // self.value
+
+    def __rmod__(self, other):
+        return other % self.value
+
+    def __rand__(self, other):
+        return other & self.value
+
+    def __ror__(self, other):
+        return other | self.value
+
+    def __rxor__(self, other):
+        return other ^ self.value
+
+    def __rrshift__(self, other):
+        return other >> self.value
+
+    def __rlshift__(self, other):
+        return other << self.value
+
     def __lt__(self, other):
         if isinstance(other, NumProxy):
             other = other.value
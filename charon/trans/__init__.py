@@ -27,6 +27,8 @@
 import os
 import ast
 import sys
+import warnings
+from concurrent.futures import ProcessPoolExecutor
 
 from .visit import AstVisitor
 from .out import Output
@@ -62,38 +64,131 @@ class FileSource(Source):
 
 
 class DirectorySource(Source):
-    pass
+    """All Python modules in a directory and its subdirectories.
+
+    Hidden files and directories and __pycache__ are skipped.  Units are
+    named by their path relative to the directory.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get_units(self):
+        units = []
+        for (dirpath, dirnames, filenames) in os.walk(self.path):
+            dirnames[:] = sorted(d for d in dirnames
+                                 if not d.startswith('.') and
+                                 d != '__pycache__')
+            for fn in sorted(filenames):
+                if fn.endswith('.py') and not fn.startswith('.'):
+                    path = os.path.join(dirpath, fn)
+                    with open(path) as fp:
+                        units.append(Unit(os.path.relpath(path, self.path),
+                                          fp.read()))
+        return units
 
 
 class Unit:
 
     ast = None
     generated = None
+    warnings = ()
 
     def __init__(self, name, code):
         self.name = name
         self.code = code
 
 
+def translate_code(name, code):
+    """Translate one unit; returns (success, generated code, warnings).
+
+    This is what worker processes of Translator.run() execute.
+    """
+    unit = Unit(name, code)
+    return Translator(None).translate(unit), unit.generated, unit.warnings
+
+
 class Translator:
+    """Translates the units of a source.
 
-    def __init__(self, source):
+    Units are translated in parallel by up to jobs processes (default: one
+    per CPU).  If a Cache is given, units found in it are not translated
+    again, and the others are added to it.  Warnings emitted while
+    translating a unit are kept with it and printed again on a cache hit.
+
+    The generated code is written to stdout, or if output_dir is given, to
+    one file per unit in it (named like the unit, with .st instead of .py).
+    Files whose content would not change are not written.
+    """
+
+    def __init__(self, source, jobs=None, cache=None, output_dir=None):
         self.source = source
+        self.jobs = jobs
+        self.cache = cache
+        self.output_dir = output_dir
         self.units = []
 
     def run(self):
         success = True
-        for unit in self.source.get_units():
-            if self.parse(unit):
-                if self.translate_ast(unit):
-                    if self.generate(unit):
-                        self.units.append(unit)
-                        continue
-            success = False
+        units = self.source.get_units()
+        todo = [unit for unit in units if not self.cache_get(unit)]
+        if len(todo) > 1 and self.jobs != 1:
+            jobs = self.jobs or os.cpu_count()
+            with ProcessPoolExecutor(jobs) as pool:
+                results = pool.map(translate_code,
+                                   [unit.name for unit in todo],
+                                   [unit.code for unit in todo],
+                                   chunksize=max(1, len(todo) // (4 * jobs)))
+                for (unit, (ok, generated, warns)) in zip(todo, results):
+                    unit.warnings = warns
+                    if ok:
+                        unit.generated = generated
+                        self.cache_put(unit)
+        else:
+            for unit in todo:
+                if self.translate(unit):
+                    self.cache_put(unit)
+                else:
+                    unit.generated = None
+        for unit in units:
+            for msg in unit.warnings:
+                sys.stderr.write(msg)
+            if unit.generated is None:
+                success = False
+            else:
+                self.units.append(unit)
+        if self.cache is not None:
+            self.cache.evict()
         success &= self.finish()
         success &= self.emit()
         return success
 
+    def translate(self, unit):
+        """Run all steps up to generate on one unit, recording the warnings
+        emitted meanwhile in unit.warnings."""
+        with warnings.catch_warnings(record=True) as caught:
+            ok = self.parse(unit) and self.translate_ast(unit) and \
+                self.generate(unit)
+        unit.warnings = [warnings.formatwarning(w.message, w.category,
+                                                w.filename, w.lineno, w.line)
+                         for w in caught]
+        return ok
+
+    def cache_get(self, unit):
+        """Set the generated code and warnings of unit from the cache, if it
+        is there."""
+        if self.cache is None:
+            return False
+        entry = self.cache.get(unit.code)
+        if entry is None:
+            return False
+        unit.generated, unit.warnings = entry
+        return True
+
+    def cache_put(self, unit):
+        if self.cache is not None:
+            self.cache.put(unit.code, unit.generated, unit.warnings)
+
     def parse(self, unit):
         try:
             unit.ast = ast.parse(unit.code, unit.name)
@@ -110,14 +205,30 @@ class Translator:
         return not checker.failed
 
     def generate(self, unit):
+        out = Output()
         for pou in unit.project.pous:
-            out = Output(sys.stdout)
             pou.generate(out)
             out.push('\n\n')
+        unit.generated = out.getvalue()
         return True
 
     def finish(self):
         return True
 
     def emit(self):
+        if self.output_dir is None:
+            sys.stdout.write(''.join(unit.generated for unit in self.units))
+            return True
+        for unit in self.units:
+            path = os.path.join(self.output_dir,
+                                os.path.splitext(unit.name)[0] + '.st')
+            try:
+                with open(path) as fp:
+                    if fp.read() == unit.generated:
+                        continue
+            except OSError:
+                pass
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as fp:
+                fp.write(unit.generated)
         return True
@@ -0,0 +1,117 @@
+#  -*- coding: utf-8 -*-
+# *****************************************************************************
+# Python/ST language tools
+# Copyright (c) 2016 by the contributors (see AUTHORS)
+#
+# This program is free software; you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation; either version 2 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program; if not, write to the Free Software Foundation, Inc.,
+# 59 Temple Place, Suite 330, Boston, MA  02111-1307  USA
+#
+# Module authors:
+#   Georg Brandl <g.brandl@fz-juelich.de>
+#
+# *****************************************************************************
+
+"""Persistent cache of translated units."""
+
+import os
+import sys
+import json
+import hashlib
+
+import charon
+
+
+def translator_digest():
+    """Returns a hash of everything besides the source that determines the
+    generated code: the version of charon and Python, and the code of the
+    translator itself (so that changes during development are noticed)."""
+    digest = hashlib.sha256(('%s\0%d.%d\0' % (
+        charon.__version__, sys.version_info[0], sys.version_info[1])
+    ).encode())
+    basedir = os.path.dirname(__file__)
+    for fn in sorted(os.listdir(basedir)):
+        if fn.endswith('.py'):
+            with open(os.path.join(basedir, fn), 'rb') as fp:
+                digest.update(fp.read())
+    return digest.digest()
+
+
+class Cache:
+    """Generated code of units and the warnings emitted while translating
+    them, stored in a directory, keyed by the source of the unit, the
+    translator and the options that influence the output.
+
+    Each hit marks the entry as recently used (by its modification time).
+    When entries have been added, the least recently used ones are removed
+    until the cache is below max_size bytes.
+    """
+
+    def __init__(self, directory, max_size=100 << 20, options=()):
+        self.directory = directory
+        self.max_size = max_size
+        self.prefix = translator_digest() + repr(sorted(options)).encode()
+        self.added = False
+
+    def path(self, code):
+        key = hashlib.sha256(self.prefix + code.encode()).hexdigest()
+        return os.path.join(self.directory, key[:2], key[2:] + '.json')
+
+    def get(self, code):
+        """Returns (generated code, warnings) for code, or None."""
+        path = self.path(code)
+        try:
+            with open(path) as fp:
+                entry = json.load(fp)
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return entry['generated'], entry['warnings']
+
+    def put(self, code, generated, warnings=()):
+        path = self.path(code)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write under a temporary name, for concurrent builds
+        tmp = '%s.%d' % (path, os.getpid())
+        with open(tmp, 'w') as fp:
+            json.dump({'generated': generated,
+                       'warnings': list(warnings)}, fp)
+        os.replace(tmp, path)
+        self.added = True
+
+    def evict(self):
+        """Removes the least recently used entries if the cache is too
+        big.  Only needed if entries were added."""
+        if not self.added:
+            return
+        self.added = False
+        entries = []
+        total = 0
+        for subdir in os.scandir(self.directory):
+            if not subdir.is_dir():
+                continue
+            for entry in os.scandir(subdir.path):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+                total += st.st_size
+        if total <= self.max_size:
+            return
+        entries.sort()
+        for (_, size, path) in entries:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total -= size
+            if total <= self.max_size:
+                break
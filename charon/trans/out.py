@@ -27,15 +27,20 @@
 from . import st_ast as st
 
 
+# newline and indentation for each indent level
+_prefixes = {}
+
+
 class Output:
+    """Collects generated code; getvalue() returns it."""
 
-    def __init__(self, stream):
+    def __init__(self):
         self.indent = 0
-        self.w = stream
+        self.parts = []
 
     def push(self, item):
         if isinstance(item, str):
-            self.w.write(item)
+            self.parts.append(item)
         elif isinstance(item, st.Node):
             item.generate(self)
 
@@ -43,10 +48,15 @@ class Output:
         for i, item in enumerate(items):
             self.push(item)
             if i != len(items) - 1:
-                self.push(sep)
+                self.parts.append(sep)
 
     def push_line(self, item):
-        self.w.write('\n' + ' ' * self.indent)
+        parts = self.parts
+        try:
+            parts.append(_prefixes[self.indent])
+        except KeyError:
+            prefix = _prefixes[self.indent] = '\n' + ' ' * self.indent
+            parts.append(prefix)
         self.push(item)
 
     def more_indent(self):
@@ -54,3 +64,7 @@ class Output:
 
     def less_indent(self):
         self.indent -= 4
+
+    def getvalue(self):
+        """Return the collected code."""
+        return ''.join(self.parts)
@@ -24,38 +24,78 @@
 
 """AST for ST code."""
 
+import os
+
+# Node constructors check the types of the fields only in debug mode, which
+# is selected by setting CHARON_DEBUG in the environment.
+DEBUG = bool(os.environ.get('CHARON_DEBUG'))
+
+
+def make_init(cls):
+    """Generate a constructor that only sets the fields."""
+    names = [fld for (fld, _) in cls.fields]
+    code = 'def __init__(self%s):\n    self.parent = None\n' % (
+        ', *, ' + ', '.join(names) if names else '')
+    code += ''.join('    self.%s = %s\n' % (fld, fld) for fld in names)
+    namespace = {}
+    exec(code, namespace)
+    init = namespace['__init__']
+    init.__qualname__ = '%s.__init__' % cls.__name__
+    return init
+
+
+def make_checking_init(cls):
+    """Make a constructor that checks the types of the fields."""
+
+    def init(self, **kwds):
+        self.parent = None
+        for (fld, spec) in cls.fields:
+            if fld not in kwds:
+                raise TypeError('missing %s keyword in %s constructor' %
+                                (fld, cls.__name__))
+            val = kwds.pop(fld)
+            if isinstance(spec, list):
+                if not (isinstance(val, list) and
+                        all(isinstance(v, spec[0]) for v in val)):
+                    raise TypeError('%s constructor: %s should be list '
+                                    'of %s' % (cls.__name__, fld,
+                                               spec[0].__name__))
+            else:
+                if not isinstance(val, spec):
+                    raise TypeError('%s constructor: %s should be %s' %
+                                    (cls.__name__, fld, spec.__name__))
+            setattr(self, fld, val)
+        if kwds:
+            raise TypeError('invalid keywords in %s constructor: %s' %
+                            (cls.__name__, sorted(kwds)))
+
+    return init
+
 
 class NodeMeta(type):
-    def __init__(cls, name, bases, attrs):
+    def __new__(mcs, name, bases, attrs):
+        # slots for the fields that the bases do not have yet
+        if '__slots__' not in attrs:
+            inherited = set()
+            for base in bases:
+                for klass in base.__mro__:
+                    inherited.update(getattr(klass, '__slots__', ()))
+            attrs['__slots__'] = tuple(fld for (fld, _) in
+                                       attrs.get('fields', ())
+                                       if fld not in inherited)
+        return type.__new__(mcs, name, bases, attrs)
 
-        def init(self, **kwds):
-            for (fld, spec) in cls.fields:
-                if fld not in kwds:
-                    raise TypeError('missing %s keyword in %s constructor' %
-                                    (fld, cls.__name__))
-                val = kwds.pop(fld)
-                if isinstance(spec, list):
-                    if not (isinstance(val, list) and
-                            all(isinstance(v, spec[0]) for v in val)):
-                        raise TypeError('%s constructor: %s should be list '
-                                        'of %s' % (cls.__name__, fld,
-                                                   spec[0].__name__))
-                else:
-                    if not isinstance(val, spec):
-                        raise TypeError('%s constructor: %s should be %s' %
-                                        (cls.__name__, fld, spec.__name__))
-                setattr(self, fld, val)
-            if kwds:
-                raise TypeError('invalid keywords in %s constructor: %s' %
-                                (cls.__name__, sorted(kwds)))
-
-        cls.__init__ = init
+    def __init__(cls, name, bases, attrs):
+        if DEBUG:
+            cls.__init__ = make_checking_init(cls)
+        else:
+            cls.__init__ = make_init(cls)
 
 
 class Node(metaclass=NodeMeta):
 
+    __slots__ = ('parent',)
     fields = []
-    parent = None
 
     def generate(self, out):
         raise NotImplementedError
@@ -31,6 +31,14 @@ from . import st_ast as st
 
 class AstVisitor(ast.NodeVisitor):
 
+    # visitor function by node class, filled in by visit(); one per class,
+    # since subclasses may override visitors
+    _visitors = {}
+
+    def __init_subclass__(cls, **kwds):
+        super().__init_subclass__(**kwds)
+        cls._visitors = {}
+
     def __init__(self, trans):
         self.failed = False
         self.trans = trans
@@ -186,16 +194,17 @@ class AstVisitor(ast.NodeVisitor):
     def visit_AugAssign(self, node):
         lval = self.visit(node.target)
         rval = self.visit(node.value)
-        for (opcls, op) in self.binop_tbl.items():
-            if isinstance(node.op, opcls):
-                if op is None:
-                    self.bail(node, 'operator %s is not supported' % node.op)
-                return st.Assign(lval=lval, rval=st.BinOp(left=lval,
-                                                          right=rval, op=op))
-        for (opcls, op) in self.binop_func_tbl.items():
-            if isinstance(node.op, opcls):
-                return st.Assign(lval=lval, rval=st.Call(base=st.Id(id=op),
-                                                         args=[lval, rval]))
+        opcls = node.op.__class__
+        if opcls in self.binop_tbl:
+            op = self.binop_tbl[opcls]
+            if op is None:
+                self.bail(node, 'operator %s is not supported' % node.op)
+            return st.Assign(lval=lval, rval=st.BinOp(left=lval,
+                                                      right=rval, op=op))
+        if opcls in self.binop_func_tbl:
+            op = self.binop_func_tbl[opcls]
+            return st.Assign(lval=lval, rval=st.Call(base=st.Id(id=op),
+                                                     args=[lval, rval]))
         self.bail(node, 'unhandled binop?')
 
     def visit_Assign(self, node):
@@ -231,10 +240,10 @@ class AstVisitor(ast.NodeVisitor):
 
     def visit_UnaryOp(self, node):
         expr = self.visit(node.operand)
-        for (opcls, op) in self.unop_tbl.items():
-            if isinstance(node.op, opcls):
-                return st.UnOp(expr=expr, op=op)
-        self.bail(node, 'unhandled unop?')
+        op = self.unop_tbl.get(node.op.__class__)
+        if op is None:
+            self.bail(node, 'unhandled unop?')
+        return st.UnOp(expr=expr, op=op)
 
     def visit_BoolOp(self, node):
         if len(node.values) > 2:
@@ -247,14 +256,15 @@ class AstVisitor(ast.NodeVisitor):
     def visit_BinOp(self, node):
         left = self.visit(node.left)
         right = self.visit(node.right)
-        for (opcls, op) in self.binop_tbl.items():
-            if isinstance(node.op, opcls):
-                if op is None:
-                    self.bail(node, 'operator %s is not supported' % node.op)
-                return st.BinOp(left=left, right=right, op=op)
-        for (opcls, op) in self.binop_func_tbl.items():
-            if isinstance(node.op, opcls):
-                return st.Call(base=st.Id(id=op), args=[left, right])
+        opcls = node.op.__class__
+        if opcls in self.binop_tbl:
+            op = self.binop_tbl[opcls]
+            if op is None:
+                self.bail(node, 'operator %s is not supported' % node.op)
+            return st.BinOp(left=left, right=right, op=op)
+        if opcls in self.binop_func_tbl:
+            op = self.binop_func_tbl[opcls]
+            return st.Call(base=st.Id(id=op), args=[left, right])
         self.bail(node, 'unhandled binop?')
 
     def visit_Compare(self, node):
@@ -263,13 +273,13 @@ class AstVisitor(ast.NodeVisitor):
         if len(node.comparators) > 1:
             self.bail(node, 'chained comparisons not supported')
         right = self.visit(node.comparators[0])
-        for (opcls, op) in self.cmpop_tbl.items():
-            if isinstance(node.ops[0], opcls):
-                if op is None:
-                    self.bail(node, 'operator %s is not supported' %
-                              node.ops[0])
-                return st.BinOp(left=left, right=right, op=op)
-        self.bail(node, 'unhandled cmpop?')
+        opcls = node.ops[0].__class__
+        if opcls not in self.cmpop_tbl:
+            self.bail(node, 'unhandled cmpop?')
+        op = self.cmpop_tbl[opcls]
+        if op is None:
+            self.bail(node, 'operator %s is not supported' % node.ops[0])
+        return st.BinOp(left=left, right=right, op=op)
 
     def visit_List(self, node):
         exprs = self.visit_all(node.elts)
@@ -316,9 +326,13 @@ class AstVisitor(ast.NodeVisitor):
             self.bail(node, 'constant %s not supported' % node.value)
 
     def visit(self, node):
-        visitor = getattr(self, 'visit_' + node.__class__.__name__,
-                          self.visit_unknown)
-        return visitor(node)
+        try:
+            visitor = self._visitors[node.__class__]
+        except KeyError:
+            cls = self.__class__
+            visitor = self._visitors[node.__class__] = getattr(
+                cls, 'visit_' + node.__class__.__name__, cls.visit_unknown)
+        return visitor(self, node)
 
     def visit_unknown(self, node):
         self.bail(node, 'construct %s is not allowed' %